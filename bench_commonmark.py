@@ -0,0 +1,614 @@
+from __future__ import print_function, division
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import re
+import sys
+import tempfile
+import timeit
+from array import array
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import commonmark
+
+
+SPEC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spec.txt')
+
+
+# A line of ordinary paragraph text with a sprinkling of inline markup.
+PARAGRAPH_LINE = (
+    u'Lorem ipsum *dolor* sit amet, `consectetur` adipiscing [elit](/url) '
+    u'sed do eiusmod &amp; tempor.\n'
+)
+
+
+# Lines exercising each kind of block start.
+BLOCK_LINES = [
+    u'# A header',
+    u'Some paragraph text with a few words in it.',
+    u'and a lazy continuation line.',
+    u'',
+    u'- a list item',
+    u'  continued inside the item',
+    u'> a block quote',
+    u'    indented code',
+    u'',
+    u'***',
+    u'1. an ordered item',
+    u'',
+]
+
+# A paragraph subject exercising each kind of inline.
+INLINE_SUBJECT = (
+    u'plain *emph* __strong__ `code` <http://example.com> <b>html</b> '
+    u'&copy; \\* [link](/url "title") ![img](/src) [ref] text\n'
+)
+
+
+def count_inlines(inlines):
+    """
+    Return the number of inlines in a list, including nested ones.
+    """
+    total = 0
+    for inline in inlines:
+        total += 1
+        if isinstance(inline.c, list):
+            total += count_inlines(inline.c)
+        label = getattr(inline, 'label', None)
+        if label:
+            total += count_inlines(label)
+    return total
+
+
+def ast_size(block):
+    """
+    Return the number of nodes in a parsed document and the bytes taken by
+    the nodes, their attribute dicts and their lists.  Strings are left
+    out as they are shared with the input.
+    """
+    nodes = 0
+    size = 0
+    stack = [block]
+    seen = set()
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, list):
+            size += sys.getsizeof(obj)
+            stack.extend(obj)
+        elif isinstance(obj, (commonmark.Block, commonmark.Inline)):
+            nodes += 1
+            size += sys.getsizeof(obj)
+            attributes = getattr(obj, '__dict__', None)
+            if attributes is not None:
+                size += sys.getsizeof(attributes)
+            for k, v in obj.attributes().items():
+                if k != 'parent':
+                    stack.append(v)
+    return nodes, size
+
+
+def make_comments(count):
+    """
+    Return count short documents, like user comments, each a few lines of
+    BLOCK_LINES followed by INLINE_SUBJECT.
+    """
+    comments = []
+    for i in range(count):
+        start = i % len(BLOCK_LINES)
+        lines = (BLOCK_LINES * 2)[start:start + 4 + i % 5]
+        comments.append(u'\n'.join(lines) + u'\n\n' + INLINE_SUBJECT)
+    return comments
+
+
+def repeat_to_size(text, size):
+    """
+    Return text repeated and cut to about size characters, at a line end
+    where there is one.
+    """
+    text = text * (size // len(text) + 1)
+    end = text.rfind(u'\n', 0, size)
+    return text[:end + 1 if end > size // 2 else size]
+
+
+def make_spec(size):
+    """ The spec.txt examples, concatenated. """
+    with io.open(SPEC_PATH, encoding='utf-8') as f:
+        spec = f.read()
+    examples = re.findall(r'^\.\n(.*?)^\.\n', spec, re.M | re.S)
+    return repeat_to_size(u'\n'.join(examples).replace(u'\u2192', u'\t'), size)
+
+
+def make_nested_brackets(size):
+    """
+    A paragraph of nested brackets that never form links, after a
+    reference definition so that each label is looked up.
+    """
+    depth = max(1, size // 3)
+    return u'[x]: /u\n\n' + u'[' * depth + u'a' + u']' * depth
+
+
+def make_unmatched_emphasis(size):
+    """ Emphasis openers of both kinds that are never closed. """
+    return repeat_to_size(u'*a _b **c __d ', size)
+
+
+def make_unclosed_backticks(size):
+    """ Backtick runs of increasing length, none of them closed. """
+    chunks = []
+    total = 0
+    n = 1
+    while total < size:
+        chunks.append(u'`' * n + u'a ')
+        total += n + 2
+        n += 1
+    return u''.join(chunks)
+
+
+def make_deep_nesting(size):
+    """ Block quotes and lists nested 50 deep, repeated. """
+    quote = u''.join(u'> ' * depth + u'quoted\n' for depth in range(1, 51))
+    items = u''.join(u'  ' * depth + u'- item\n' for depth in range(50))
+    return repeat_to_size(quote + u'\n' + items + u'\n', size)
+
+
+def make_reference_table(size):
+    """ A long table of link reference definitions, then uses of them. """
+    count = max(1, size // 60)
+    definitions = u''.join(u'[label {0}]: /url/{0} "title {0}"\n'.format(i) for i in range(count))
+    uses = u' '.join(u'[label {0}]'.format(i) for i in range(0, count, 7))
+    return definitions + u'\n' + uses + u'\n'
+
+
+def make_html_comment(size):
+    """ One huge HTML comment, as a block and inline. """
+    body = repeat_to_size(u'comment text -\n', size // 2)
+    return u'<!--\n' + body + u'-->\n\ntext <!-- ' + body.replace(u'\n', u' ') + u' -->\n'
+
+
+def make_entities(size):
+    """ Text dense with named and numeric entities, in every context. """
+    return repeat_to_size(
+        u'&copy; &amp; &ClockwiseContourIntegral; &#35; &#x1F600; &nbsp;&frac34; &MadeUp;\n'
+        u'[&lt;link&gt;](/a&amp;b?c=&quot;d&quot; "&ldquo;title&rdquo;") &#X22;&#1234;\n\n'
+        u'``` python&nbsp;&amp;\ncode &amp; more\n```\n\n', size)
+
+
+def make_changelog(size):
+    """ A changelog, linking the same few issues, commits and images. """
+    entry = u''.join(
+        u'- Fix [#{0}](https://github.com/org/repo/issues/{0}) in '
+        u'[{1:07x}](https://github.com/org/repo/commit/{1:07x}) '
+        u'![build](https://ci.example.com/badge.svg?branch=main)\n'.format(n, n * 7919)
+        for n in range(1, 21))
+    return repeat_to_size(u'## Release\n\n' + entry + u'\n', size)
+
+
+# Inputs of the suite benchmark: real-world-like text and the shapes that
+# have made parsers slow.
+CORPORA = [
+    ('spec', make_spec),
+    ('paragraphs', lambda size: make_paragraph(size)),
+    ('nested-brackets', make_nested_brackets),
+    ('unmatched-emphasis', make_unmatched_emphasis),
+    ('unclosed-backticks', make_unclosed_backticks),
+    ('deep-nesting', make_deep_nesting),
+    ('reference-table', make_reference_table),
+    ('html-comment', make_html_comment),
+    ('entities', make_entities),
+    ('changelog', make_changelog),
+]
+
+PHASES = ['block', 'inline', 'render', 'total']
+
+
+def time_phases(text, repeat):
+    """
+    Return the best time, in seconds, of each phase of parsing and
+    rendering text: block structure, inlines and rendering.
+    """
+    renderer = commonmark.HtmlRenderer()
+    timer = timeit.default_timer
+    best = {}
+    for _ in range(repeat):
+        parser = commonmark.DocParser()
+        start = timer()
+        parser.reset()
+        parser.buffer = text
+        parser.finalize_document()
+        blocks_done = timer()
+        parser.process_inlines(parser.doc)
+        inlines_done = timer()
+        renderer.render_block(parser.doc)
+        end = timer()
+        times = {
+            'block': blocks_done - start,
+            'inline': inlines_done - blocks_done,
+            'render': end - inlines_done,
+            'total': end - start,
+        }
+        for phase, elapsed in times.items():
+            best[phase] = min(best.get(phase, elapsed), elapsed)
+    return best
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Print the cases where throughput dropped below the baseline's divided
+    by tolerance, and return how many there were.
+    """
+    previous = dict(((r['corpus'], r['bytes'], r['phase']), r['mb_per_s']) for r in baseline['results'])
+    regressions = 0
+    for result in results:
+        key = (result['corpus'], result['bytes'], result['phase'])
+        if key in previous and result['mb_per_s'] * tolerance < previous[key]:
+            regressions += 1
+            print('REGRESSION: {0} {1} bytes {2}: {3:.3f} MB/s, was {4:.3f} MB/s'.format(
+                key[0], key[1], key[2], result['mb_per_s'], previous[key]))
+    print('{0} regressions against the baseline'.format(regressions))
+    return regressions
+
+
+def make_paragraph(size):
+    """
+    Return a single paragraph of roughly size characters.
+    """
+    count = max(1, size // len(PARAGRAPH_LINE))
+    return PARAGRAPH_LINE * count
+
+
+def best_time(func, repeat):
+    """
+    Return the best wall time, in seconds, of repeat calls to func.
+    """
+    timer = timeit.default_timer
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        func()
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_scaling(args):
+    """
+    Parse single paragraphs of increasing size.  The time per byte should
+    stay flat as the paragraph grows.
+    """
+    print('{0:>10}  {1:>10}  {2:>10}'.format('bytes', 'parse (s)', 'us/byte'))
+    size = args.min_size
+    while size <= args.max_size:
+        text = make_paragraph(size)
+        elapsed = best_time(lambda: commonmark.DocParser().parse(text), args.repeat)
+        print('{0:>10}  {1:>10.4f}  {2:>10.3f}'.format(
+            len(text), elapsed, elapsed * 1e6 / len(text)))
+        size *= 2
+
+
+def bench_overhead(args):
+    """
+    Measure the fixed cost of incorporate_line per line of block input,
+    and of InlineParser per inline parsed.
+    """
+    lines = BLOCK_LINES * (args.count // len(BLOCK_LINES))
+
+    def incorporate():
+        parser = commonmark.DocParser()
+        for i, line in enumerate(lines):
+            parser.incorporate_line(line, i + 1)
+
+    elapsed = best_time(incorporate, args.repeat)
+    print('incorporate_line: {0:8.2f} us/line'.format(elapsed * 1e6 / len(lines)))
+
+    subject = INLINE_SUBJECT * (args.count // 20)
+    refmap = {u'REF': commonmark.Link(u'/ref', u'')}
+    count = count_inlines(commonmark.InlineParser().parse(subject, refmap))
+    elapsed = best_time(lambda: commonmark.InlineParser().parse(subject, refmap), args.repeat)
+    print('InlineParser:     {0:8.2f} us/inline'.format(elapsed * 1e6 / count))
+
+
+def bench_edit(args):
+    """
+    Compare a full parse and render of a document with a one-line edit to
+    an IncrementalDocument.  The edit time should not depend on the size
+    of the document or where the edit is.
+    """
+    lines = BLOCK_LINES * (args.count // len(BLOCK_LINES))
+    text = u'\n'.join(lines)
+    renderer = commonmark.HtmlRenderer()
+    elapsed = best_time(
+        lambda: renderer.render_block(commonmark.DocParser().parse(text)), args.repeat)
+    print('{0} lines, full parse:  {1:8.2f} ms'.format(len(lines), elapsed * 1e3))
+
+    document = commonmark.IncrementalDocument(text, renderer)
+    for line in (0, len(lines) // 2, len(lines) - 2):
+        edited = [lines[line] + u' *edited*']
+
+        def edit():
+            document.edit(line, line + 1, edited)
+            document.render()
+
+        elapsed = best_time(edit, args.repeat)
+        print('edit at line {0:>6}:    {1:8.2f} ms'.format(line + 1, elapsed * 1e3))
+
+
+def bench_memory(args):
+    """
+    Measure the memory held by the AST of spec.txt repeated --scale times,
+    with tracemalloc where it is available.
+    """
+    with io.open(SPEC_PATH, encoding='utf-8') as f:
+        text = f.read() * args.scale
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        doc = commonmark.DocParser().parse(text)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('traced:      {0:10.1f} MB held  {1:10.1f} MB peak'.format(current / 2**20, peak / 2**20))
+    else:
+        doc = commonmark.DocParser().parse(text)
+
+    nodes, size = ast_size(doc)
+    print('{0} bytes of input, {1} nodes'.format(len(text), nodes))
+    print('AST objects: {0:10.1f} MB  {1:10.1f} bytes/node'.format(size / 2**20, size / nodes))
+
+    table = commonmark.NodeTable.from_block(doc)
+    size = sum(len(values) * values.itemsize for values in table.attributes().values()
+               if isinstance(values, array))
+    print('NodeTable:   {0:10.1f} MB  {1:10.1f} bytes/node, {2:.1f} MB of text'.format(
+        size / 2**20, size / len(table), sys.getsizeof(table.text) / 2**20))
+
+    renderer = commonmark.HtmlRenderer()
+    elapsed = best_time(lambda: renderer.render_block(doc), args.repeat)
+    print('render:      {0:10.4f} s'.format(elapsed))
+
+
+def bench_batch(args):
+    """
+    Render a corpus of short comments with render_many, doubling the number
+    of workers up to --workers.  The speedup should stay close to the
+    number of workers, up to the number of cores.
+    """
+    comments = make_comments(args.count)
+    print('{0} comments, {1} cores'.format(len(comments), multiprocessing.cpu_count()))
+    print('{0:>8}  {1:>10}  {2:>10}  {3:>8}'.format('workers', 'time (s)', 'docs/s', 'speedup'))
+    base = None
+    workers = 1
+    while workers <= args.workers:
+        elapsed = best_time(
+            lambda: list(commonmark.render_many(comments, workers, args.chunksize)), args.repeat)
+        base = base or elapsed
+        print('{0:>8}  {1:>10.3f}  {2:>10.0f}  {3:>8.2f}'.format(
+            workers, elapsed, len(comments) / elapsed, base / elapsed))
+        workers *= 2
+
+
+def bench_memo(args):
+    """
+    Re-render a document of --paragraphs paragraphs after changing one of
+    them, with and without a BlockMemo.  With the memo only the changed
+    paragraph should be parsed into inlines and rendered again.
+    """
+    paragraphs = [u'Paragraph {0}: {1}'.format(i, INLINE_SUBJECT) for i in range(args.paragraphs)]
+    before = u'\n'.join(paragraphs)
+    paragraphs[len(paragraphs) // 2] = u'A *changed* paragraph.\n'
+    after = u'\n'.join(paragraphs)
+
+    renderer = commonmark.HtmlRenderer()
+    elapsed = best_time(lambda: renderer.render_block(commonmark.DocParser().parse(after)), args.repeat)
+    print('no memo:   {0:8.2f} ms'.format(elapsed * 1e3))
+
+    def render_revision():
+        memo = commonmark.BlockMemo()
+        parser = commonmark.DocParser(memo)
+        renderer = commonmark.HtmlRenderer(memo)
+        renderer.render_block(parser.parse(before))
+        misses = memo.misses
+        start = timeit.default_timer()
+        renderer.render_block(parser.parse(after))
+        return timeit.default_timer() - start, memo.misses - misses
+
+    elapsed, misses = min(render_revision() for _ in range(args.repeat))
+    print('memo:      {0:8.2f} ms, {1} blocks parsed into inlines again'.format(elapsed * 1e3, misses))
+
+
+def bench_suite(args):
+    """
+    Parse and render each corpus at sizes from --min-size to --max-size,
+    reporting the throughput of each phase in MB/s.  With --output the
+    results are saved as JSON, and with --baseline they are compared to
+    such a file; the exit status is 1 if any phase got slower by more
+    than --tolerance.
+    """
+    names = args.corpus or [name for name, _ in CORPORA]
+    makers = dict(CORPORA)
+    results = []
+    print('{0:<20} {1:>9}'.format('corpus', 'bytes') +
+          ''.join('  {0:>8}'.format(phase) for phase in PHASES) + '   (MB/s)')
+    for name in names:
+        size = args.min_size
+        while size <= args.max_size:
+            text = makers[name](size)
+            nbytes = len(text.encode('utf-8'))
+            times = time_phases(text, args.repeat)
+            line = '{0:<20} {1:>9}'.format(name, nbytes)
+            for phase in PHASES:
+                mb_per_s = nbytes / 2**20 / max(times[phase], 1e-9)
+                results.append({
+                    'corpus': name,
+                    'bytes': nbytes,
+                    'phase': phase,
+                    'seconds': times[phase],
+                    'mb_per_s': mb_per_s,
+                })
+                line += '  {0:>8.3f}'.format(mb_per_s)
+            print(line)
+            size *= 2
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'commonmark': commonmark.__version__,
+                'results': results,
+            }, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_results(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+def write_corpus(path, make, size):
+    """
+    Write about size bytes of a corpus to path as UTF-8, a megabyte of
+    make() at a time.
+    """
+    block = make(2**20).encode('utf-8')
+    with open(path, 'wb') as f:
+        for _ in range(max(1, -(-size // len(block)))):
+            f.write(block)
+
+
+def read_and_parse(path):
+    with io.open(path, encoding='utf-8', newline='') as f:
+        text = f.read()
+    commonmark.DocParser().parse(text)
+
+
+def read_and_render(path):
+    with io.open(path, encoding='utf-8', newline='') as f:
+        text = f.read()
+    html = commonmark.HtmlRenderer().render_block(commonmark.DocParser().parse(text))
+    with open(os.devnull, 'wb') as out:
+        out.write(html.encode('utf-8'))
+
+
+def render_path(path, defer_references=True):
+    with open(os.devnull, 'wb') as out:
+        commonmark.render_path(path, out, defer_references=defer_references)
+
+
+# The ways of turning a file into a document or HTML compared by the path
+# benchmark.
+PATH_METHODS = [
+    ('idle', None),
+    ('read + parse', read_and_parse),
+    ('parse_path', lambda path: commonmark.DocParser().parse_path(path)),
+    ('read + render', read_and_render),
+    ('render_path', render_path),
+    ('render_path, no deferring', lambda path: render_path(path, False)),
+]
+
+
+def run_measured(func, path, conn):
+    """
+    Call func(path), if given, and send its wall time and the peak RSS of the
+    process, in bytes, down conn.
+    """
+    start = timeit.default_timer()
+    if func is not None:
+        func(path)
+    elapsed = timeit.default_timer() - start
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send((elapsed, peak if sys.platform == 'darwin' else peak * 1024))
+    conn.close()
+
+
+def bench_path(args):
+    """
+    Compare parse_path and render_path with reading the whole file and
+    calling parse, on a file of --file-mb megabytes of the first --corpus
+    (spec by default).
+    Each method runs in a process of its own so that its peak RSS can be
+    measured; 'idle' is the peak of a process doing nothing.
+    """
+    if resource is None:
+        print('The path benchmark needs the resource module.')
+        return
+    path = args.file
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.md')
+        os.close(fd)
+    try:
+        if args.file is None or not os.path.exists(path):
+            write_corpus(path, dict(CORPORA)[(args.corpus or ['spec'])[0]], args.file_mb * 2**20)
+        size = os.path.getsize(path)
+        print('{0:.1f} MB of input'.format(size / 2**20))
+        print('{0:<26}  {1:>10}  {2:>10}  {3:>12}'.format('method', 'time (s)', 'MB/s', 'peak RSS (MB)'))
+        for name, func in PATH_METHODS:
+            receiver, sender = multiprocessing.Pipe(False)
+            process = multiprocessing.Process(target=run_measured, args=(func, path, sender))
+            process.start()
+            elapsed, peak = receiver.recv()
+            process.join()
+            throughput = '-' if func is None else '{0:.3f}'.format(size / 2**20 / elapsed)
+            print('{0:<26}  {1:>10.2f}  {2:>10}  {3:>12.1f}'.format(
+                name, elapsed, throughput, peak / 2**20))
+    finally:
+        if args.file is None:
+            os.remove(path)
+
+
+BENCHMARKS = {
+    'scaling': bench_scaling,
+    'overhead': bench_overhead,
+    'edit': bench_edit,
+    'memory': bench_memory,
+    'batch': bench_batch,
+    'memo': bench_memo,
+    'suite': bench_suite,
+    'path': bench_path,
+}
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', nargs='?', default='scaling', choices=sorted(BENCHMARKS))
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--min-size', type=int, default=16 * 1024)
+    parser.add_argument('--max-size', type=int, default=1024 * 1024)
+    parser.add_argument('-n', '--count', type=int, default=20000)
+    parser.add_argument('-s', '--scale', type=int, default=10)
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunksize', type=int, default=64)
+    parser.add_argument('--paragraphs', type=int, default=5000)
+    parser.add_argument('--corpus', action='append', choices=[name for name, _ in CORPORA],
+                        help='Corpus for the suite benchmark (repeatable, default all), '
+                             'or of the path benchmark.')
+    parser.add_argument('-o', '--output', help='Save the suite results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare the suite results to this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='Slowdown factor reported as a regression.')
+    parser.add_argument('--file-mb', type=int, default=500,
+                        help='Size of the generated input of the path benchmark.')
+    parser.add_argument('--file', help='Input of the path benchmark, generated '
+                                       'if it does not exist and kept.')
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,14 +9,26 @@ License: BSD3
 """
 
 import re
-import urllib
+import bisect
+from array import array
+import codecs
+import hashlib
+import io
+import itertools
+import os
+import sys
 import urllib2
 import urlparse
 import HTMLParser
 import logging
+import mmap
+import multiprocessing
+import tempfile
+import threading
+from collections import OrderedDict, deque, namedtuple
 from pprint import pprint, pformat
+from timeit import default_timer
 
-import html5charref
 
 
 __version__ = '0.1.0'
@@ -44,6 +56,7 @@ _block_tag_names = [
     'script', 'style',
 ]
 BLOCKTAGNAME = '(?:{0})'.format('|'.join(_block_tag_names))
+
 ATTRIBUTENAME = '[a-zA-Z_:][a-zA-Z0-9:._-]*'
 UNQUOTEDVALUE = "[^\"'=<>`\\x00-\\x20]+"
 SINGLEQUOTEDVALUE = "'[^']*'"
@@ -55,42 +68,148 @@ OPENTAG = "<" + TAGNAME + ATTRIBUTE + "*" + "\\s*/?>"
 CLOSETAG = "</" + TAGNAME + "\\s*[>]"
 OPENBLOCKTAG = "<" + BLOCKTAGNAME + ATTRIBUTE + "*" + "\\s*/?>"
 CLOSEBLOCKTAG = "</" + BLOCKTAGNAME + "\\s*[>]"
-HTMLCOMMENT = "<!--([^-]+|[-][^-]+)*-->"
+# One character at a time, so that an unclosed comment or CDATA section
+# can't make the match backtrack exponentially.
+HTMLCOMMENT = "<!--(?:[^-]|[-][^-])*-->"
 PROCESSINGINSTRUCTION = "[<][?].*?[?][>]"
 DECLARATION = "<![A-Z]+" + "\\s+[^>]*>"
-CDATA = "<!\\[CDATA\\[([^\\]]+|\\][^\\]]|\\]\\][^>])*\\]\\]>"
+CDATA = "<!\\[CDATA\\[(?:[^\\]]|\\][^\\]]|\\]\\][^>])*\\]\\]>"
 HTMLTAG = "(?:" + OPENTAG + "|" + CLOSETAG + "|" + HTMLCOMMENT + "|" + PROCESSINGINSTRUCTION + "|" + DECLARATION + "|" + CDATA + ")"
 HTMLBLOCKOPEN = "<(?:" + BLOCKTAGNAME + "[\\s/>]" + "|" + "/" + BLOCKTAGNAME + "[\\s>]" + "|" + "[?!])"
 
-reHtmlTag = re.compile('^' + HTMLTAG, re.I)
+# The patterns below are applied at an offset with ``regex.match(s, pos)``
+# rather than to a slice of the subject, so they must not be anchored with
+# '^' (which only ever matches at the real start of the string).
+reHtmlTag = re.compile(HTMLTAG, re.I)
 
-reHtmlBlockOpen = re.compile('^' + HTMLBLOCKOPEN, re.I)
+reHtmlBlockOpen = re.compile(HTMLBLOCKOPEN, re.I)
 
 reLinkTitle = re.compile(
-    '^(?:"(' + ESCAPED_CHAR + '|[^"\\x00])*"' +
+    '(?:"(' + ESCAPED_CHAR + '|[^"\\x00])*"' +
     '|' +
     '\'(' + ESCAPED_CHAR + '|[^\'\\x00])*\'' +
     '|' +
     '\\((' + ESCAPED_CHAR + '|[^)\\x00])*\\))')
 
 reLinkDestinationBraces = re.compile(
-    '^(?:[<](?:[^<>\\n\\\\\\x00]' + '|' + ESCAPED_CHAR + '|' + '\\\\)*[>])')
+    '(?:[<](?:[^<>\\n\\\\\\x00]' + '|' + ESCAPED_CHAR + '|' + '\\\\)*[>])')
 
 reLinkDestination = re.compile(
-    '^(?:' + REG_CHAR + '+|' + ESCAPED_CHAR + '|' + IN_PARENS_NOSP + ')*')
+    '(?:' + REG_CHAR + '+|' + ESCAPED_CHAR + '|' + IN_PARENS_NOSP + ')*')
 
 RE_ESCAPABLE = re.compile(ESCAPABLE)
 
 reAllEscapedChar = re.compile('\\\\(' + ESCAPABLE + ')')
 
-reEscapedChar = re.compile('^\\\\(' + ESCAPABLE + ')')
-
-reHrule = re.compile('^(?:(?:\* *){3,}|(?:_ *){3,}|(?:- *){3,}) *$')
+reHrule = re.compile('(?:(?:\* *){3,}|(?:_ *){3,}|(?:- *){3,}) *$')
 
 # Matches a character with a special meaning in markdown,
 # or a string of non-special characters.
 reMain = re.compile(r'(?:[\n`\[\]\\!<&*_]|[^\n`\[\]\\!<&*_]+)', re.M)
 
+reEntity = re.compile(r'&(?:#x[a-f0-9]{1,8}|#[0-9]{1,8}|[a-z][a-z0-9]{1,31});', re.I)
+
+# URI schemes recognised in autolinks, checked against the lowercased
+# scheme of a candidate autolink.
+AUTOLINK_SCHEMES = frozenset([
+    'coap', 'doi', 'javascript', 'aaa', 'aaas', 'about', 'acap',
+    'cap', 'cid', 'crid', 'data', 'dav', 'dict', 'dns', 'file',
+    'ftp', 'geo', 'go', 'gopher', 'h323', 'http', 'https', 'iax',
+    'icap', 'im', 'imap', 'info', 'ipp', 'iris', 'iris.beep',
+    'iris.xpc', 'iris.xpcs', 'iris.lwz', 'ldap', 'mailto', 'mid',
+    'msrp', 'msrps', 'mtqp', 'mupdate', 'news', 'nfs', 'ni',
+    'nih', 'nntp', 'opaquelocktoken', 'pop', 'pres', 'rtsp',
+    'service', 'session', 'shttp', 'sieve', 'sip', 'sips', 'sms',
+    'snmp', 'soap.beep', 'soap.beeps', 'tag', 'tel', 'telnet',
+    'tftp', 'thismessage', 'tn3270', 'tip', 'tv', 'urn', 'vemmi',
+    'ws', 'wss', 'xcon', 'xcon-userid', 'xmlrpc.beep',
+    'xmlrpc.beeps', 'xmpp', 'z39.50r', 'z39.50s', 'adiumxtra',
+    'afp', 'afs', 'aim', 'apt', 'attachment', 'aw', 'beshare',
+    'bitcoin', 'bolo', 'callto', 'chrome', 'chrome-extension',
+    'com-eventbrite-attendee', 'content', 'cvs', 'dlna-playsingle',
+    'dlna-playcontainer', 'dtn', 'dvb', 'ed2k', 'facetime',
+    'feed', 'finger', 'fish', 'gg', 'git', 'gizmoproject', 'gtalk',
+    'hcp', 'icon', 'ipn', 'irc', 'irc6', 'ircs', 'itms', 'jar',
+    'jms', 'keyparc', 'lastfm', 'ldaps', 'magnet', 'maps',
+    'market', 'message', 'mms', 'ms-help', 'msnim', 'mumble',
+    'mvn', 'notes', 'oid', 'palm', 'paparazzi', 'platform',
+    'proxy', 'psyc', 'query', 'res', 'resource', 'rmi', 'rsync',
+    'rtmp', 'secondlife', 'sftp', 'sgn', 'skype', 'smb', 'soldat',
+    'spotify', 'ssh', 'steam', 'svn', 'teamspeak', 'things',
+    'udp', 'unreal', 'ut2004', 'ventrilo', 'view-source',
+    'webcal', 'wtai', 'wyciwyg', 'xfire', 'xri', 'ymsgr',
+])
+
+reEmailAutolink = re.compile(r'<([a-zA-Z0-9.!#$%&\'*+\\/=?^_`{|}~-]+@[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?(?:\.[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*)>')
+
+# The scheme is checked against AUTOLINK_SCHEMES after matching.
+reAutolink = re.compile(r'<([a-zA-Z0-9.+-]+):[^<>\x00-\x20]*>')
+
+reTicks = re.compile(r'`+')
+
+reSpnl = re.compile(r' *(?:\n *)?')
+
+reWhitespaceChar = re.compile(r'\s')
+
+reWhitespace = re.compile(r'\s+')
+
+reAsciiAlnum = re.compile(r'[a-z0-9]', re.I)
+
+reCodeSpanWhitespace = re.compile(r'[ \n]+')
+
+reBlank = re.compile(r'\s*$')
+
+reSpaceToEndOfLine = re.compile(r'[^\S\n]*(?:\n|$)')
+
+reTab = re.compile(r'\t')
+
+reNonSpace = re.compile(r'[^ ]')
+
+reATXHeaderMarker = re.compile(r'#{1,6}(?: +|$)')
+
+reATXTrailingHashes = re.compile(r'(.*?)(?: *(?<!\\)#*)*$')
+
+reCodeFence = re.compile(r'`{3,}(?!.*`)|~{3,}(?!.*~)')
+
+reClosingCodeFence = re.compile(r'(?:`{3,}|~{3,})(?= *$)')
+
+reSetextHeaderLine = re.compile(r'(?:=+|-+) *$')
+
+reBulletListMarker = re.compile(r'[*+-]( +|$)')
+
+reOrderedListMarker = re.compile(r'(\d+)([.)])( +|$)')
+
+# Link labels longer than this can't match a reference definition.
+MAX_LABEL_LENGTH = 999
+
+reLineEnding = re.compile(r'\r\n|\n|\r')
+
+reFinalNewline = re.compile(r'\n$')
+
+reInitialSpaces = re.compile(r'^  *')
+
+reTrailingBlankLines = re.compile(r'(\n *)*$')
+
+reInfoSeparator = re.compile(r' +')
+
+reAmpNotEntity = re.compile(r'[&](?![#](x[a-f0-9]{1,8}|[0-9]{1,8};)|[a-z][a-z0-9]{1,31};)', re.I)
+
+reHtmlSpecial = re.compile(r'[&<>"]')
+
+# URLs that url_fix would return unchanged: a relative URL or an http(s)
+# or ftp one, with nothing to percent-encode in the host, path or query,
+# and nothing urlunsplit would drop (an empty query or fragment) or add.
+reSafeUrl = re.compile(
+    r'(?:(?:https?|ftp)://[A-Za-z0-9_.\-:]+(?=[/?#]|$)|(?![A-Za-z0-9+.\-]*:|//))'
+    r'[A-Za-z0-9_.\-/%()*:]*(?:[?][A-Za-z0-9_.\-:&=*]+)?(?:#.+)?\Z', re.S)
+
+# Runs of characters url_fix percent-encodes in each part of a URL.
+reUnsafeNetloc = re.compile(r'[^A-Za-z0-9_.\-:]+')
+
+reUnsafePath = re.compile(r'[^A-Za-z0-9_.\-/%()*:]+')
+
+reUnsafeQuery = re.compile(r'[^A-Za-z0-9_.\-:&=*]+')
+
 
 class ParseError(Exception):
     """
@@ -99,6 +218,20 @@ class ParseError(Exception):
     pass
 
 
+class LimitExceeded(ParseError):
+    """
+    Raised when a document exceeds one of the limits set on a DocParser
+    or HtmlRenderer.  limit is the name of the limit exceeded, e.g.
+    'max_depth', and value the size or depth that exceeded it (the limit
+    itself for time_limit).
+    """
+
+    def __init__(self, limit, value):
+        super(LimitExceeded, self).__init__('{0} exceeded: {1}'.format(limit, value))
+        self.limit = limit
+        self.value = value
+
+
 # UTILITY FUNCTIONS
 def unescape(s):
     """ Replace backslash escapes with literal characters.
@@ -106,46 +239,79 @@ def unescape(s):
     return reAllEscapedChar.sub('\g<1>', s)
 
 
+# Characters that stay escaped when an entity decodes to them.
+HTML_ESCAPE_TABLE = {
+    u'&': u'&amp;',
+    u'"': u'&quot;',
+    u"'": u'&apos;',
+    u'>': u'&gt;',
+    u'<': u'&lt;',
+}
+
+# The ENTITIES table of commonmark/entities.py, once loaded.
+_entities = None
+
+
+def named_entities():
+    """
+    Return the table of HTML5 named character references, loading it on
+    first use.
+    
+    """
+    global _entities
+    if _entities is None:
+        from commonmark.entities import ENTITIES
+        _entities = ENTITIES
+    return _entities
+
+
 def unescape_html_entity(entity):
-    html_escape_table = {
-        "&": "&amp;",
-        '"': "&quot;",
-        "'": "&apos;",
-        ">": "&gt;",
-        "<": "&lt;",
-     }
-
-    char = html5charref.unescape(entity)
-    if char == entity:
-        if entity[1] == '#':
-            char = u'\uFFFD'
+    """
+    Decode an entity matched by reEntity.  Numeric references outside
+    the range of code points decode to U+FFFD and unknown names are left
+    as text, with the & escaped.
+    
+    """
+    if entity[1] == '#':
+        if entity[2] in 'xX':
+            code_point = int(entity[3:-1], 16)
         else:
-            char = u'&amp;' + entity[1:]
+            code_point = int(entity[2:-1])
+        try:
+            if 0xFFFF < code_point <= 0x10FFFF and sys.maxunicode == 0xFFFF:
+                # unichr can't make a surrogate pair on a narrow build.
+                char = ('\\U%08x' % code_point).decode('unicode-escape')
+            else:
+                char = unichr(code_point)
+        except (ValueError, OverflowError):
+            return u'\uFFFD'
+    else:
+        char = named_entities().get(entity[1:-1])
+        if char is None:
+            return u'&amp;' + entity[1:]
+    return HTML_ESCAPE_TABLE.get(char, char)
 
-    elif char in html_escape_table:
-        char = html_escape_table[char]
 
-    return char
+def unescape_entity_match(m):
+    return unescape_html_entity(m.group(0))
 
 
 def unescape_html(s):
-
-    def repl(m):
-        return unescape_html_entity(m.group(0))
-
-    return re.sub(
-        r'&(?:#x[a-f0-9]{1,8}|#[0-9]{1,8}|[a-z][a-z0-9]{1,31});',
-        repl,
-        s,
-        flags=re.I,
-    )
+    """
+    Decode the entities in s.  Used for link destinations, link titles
+    and fenced code info strings, which mostly have none.
+    
+    """
+    if '&' not in s:
+        return s
+    return reEntity.sub(unescape_entity_match, s)
 
 
 
 def is_blank(s):
     """ Returns true if string contains only space characters.
     """
-    return bool(re.match(r'^\s*$', s))
+    return bool(reBlank.match(s))
 
 
 def normalize_reference(s):
@@ -154,19 +320,7 @@ def normalize_reference(s):
     to single space, remove leading/trailing whitespace, case fold.
     
     """
-    return re.sub(r'\s+', ' ', s.strip()).upper()
-
-
-def match_at(regex, s, offset):
-    """
-    Attempt to match a regex in string s at offset offset.
-    Return index of match or null.
-    
-    """
-    match = regex.search(s[offset:])
-    if match:
-        return offset + match.start()
-    return None
+    return reWhitespace.sub(' ', s.strip()).upper()
 
 
 def detab_line(text):
@@ -181,46 +335,160 @@ def detab_line(text):
             repl.last_stop = offset + 1
             return result
         repl.last_stop = 0
-        return re.sub(r'\t', repl, text)
+        return reTab.sub(repl, text)
+
+
+def join_spans(spans):
+    """
+    Return the text of a list of line spans, (buf, start, end) triples,
+    joined by newlines.  Lines that follow each other in one buffer,
+    separated by single newlines, are taken with a single slice.
+    
+    """
+    if not spans:
+        return ''
+    buf, start, end = spans[0]
+    last = spans[-1][2]
+    size = len(spans) - 1
+    for span in spans:
+        if span[0] is not buf:
+            break
+        size += span[2] - span[1]
+    else:
+        if size == last - start:
+            text = buf[start:last]
+            if text.count('\n') == len(spans) - 1:
+                return text
+    return '\n'.join([b[s:e] for b, s, e in spans])
+
+
+def mapped_chunks(path, size):
+    """
+    Yield the text of a UTF-8 file in chunks of about size bytes.  The
+    file is memory-mapped and each chunk is decoded only when it is
+    reached.  Chunks end after a line ending, so no line or encoded
+    character is split between two chunks.
+    
+    """
+    with open(path, 'rb') as f:
+        length = os.fstat(f.fileno()).st_size
+        if not length:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            while start < length:
+                stop = data.find(b'\n', start + size)
+                if stop == -1:
+                    # No '\r\n' is left to split, so a lone '\r' will do.
+                    stop = data.find(b'\r', start + size)
+                stop = length if stop == -1 else stop + 1
+                yield data[start:stop].decode('utf-8')
+                start = stop
+        finally:
+            data.close()
+
+
+def strip_chunks(chunks):
+    """
+    Yield the strings in chunks with the leading and trailing whitespace of
+    their concatenation removed, holding back only trailing whitespace.
+    
+    """
+    started = False
+    pending = ''
+    for chunk in chunks:
+        if not started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            started = True
+        body = chunk.rstrip()
+        if body:
+            if pending:
+                yield pending
+            yield body
+            pending = chunk[len(body):]
+        else:
+            pending += chunk
+
+
+def walk_blocks(block):
+    """
+    Yield block and every block below it, in document order.
+    
+    """
+    stack = [block]
+    while stack:
+        b = stack.pop()
+        yield b
+        stack.extend(reversed(b.children))
 
 
-def parse_raw_label(s):
+def inline_blocks(block):
     """
-    Parse raw link label, including surrounding [], and return
-    inline contents.  (Note:  this is not a method of InlineParser.)
+    Return block and the blocks below it whose string content is parsed
+    into inline content.
     
     """
-    # Note: Parse without a refmap we don't want links to resolve
-    # in nested brackets!
-    return InlineParser().parse(s[1:-1], {})
+    return [b for b in walk_blocks(block) if b.t in ['Paragraph', 'SetextHeader', 'ATXHeader']]
+
+
+def tree_depth(node):
+    """
+    Return the number of nodes on the longest chain down from node, a
+    block or inline, counting blocks, inlines and link labels alike.
+    
+    """
+    deepest = 0
+    stack = [(node, 1)]
+    while stack:
+        node, depth = stack.pop()
+        deepest = max(deepest, depth)
+        if node.t in ['Link', 'Image']:
+            children = node.label
+        elif node.t in ['Emph', 'Strong']:
+            children = node.c
+        elif node.t in INLINE_CLASSES:
+            children = []
+        else:
+            children = list(node.children) + list(node.inline_content or [])
+        stack.extend((child, depth + 1) for child in children)
+    return deepest
 
 
 def splice(inlist, index):
-    while len(inlist) > index:
-        inlist.pop()
+    del inlist[index:]
 
 
 
-def parse_list_marker(line, offset):
+def parse_list_marker(line, offset, end=None, stats=None):
     """
     Parse a list marker and return data on the marker (type,
     start, delimiter, bullet character, padding) or null.
+    The line ends at end, if given.  The regex calls made are
+    counted in stats, if given.
     
     """
-    rest = line[offset:]
+    if end is None:
+        end = len(line)
     spaces_after_marker = None
     data = ListData()
-    if reHrule.search(rest):
+    if stats is not None:
+        stats.count_regex('block', 2)
+    if reHrule.match(line, offset, end):
         return None
 
-    match = re.match(r'^[*+-]( +|$)', rest)
+    match = reBulletListMarker.match(line, offset, end)
     if match:
         spaces_after_marker = len(match.group(1))
         data.type = 'Bullet'
         data.bullet_char = match.group(0)[0]
 
     else:
-        match = re.match(r'^(\d+)([.)])( +|$)', rest)
+        if stats is not None:
+            stats.count_regex('block')
+        match = reOrderedListMarker.match(line, offset, end)
         if match:
             spaces_after_marker = len(match.group(3))
             data.type = 'Ordered'
@@ -230,7 +498,7 @@ def parse_list_marker(line, offset):
         else:
             return None
 
-    blank_item = len(match.group(0)) == len(rest)
+    blank_item = match.end() == end
     if spaces_after_marker >= 5 or spaces_after_marker < 1 or blank_item:
         data.padding = len(match.group(0)) - spaces_after_marker + 1
     else:
@@ -278,6 +546,14 @@ def accepts_lines(block_type):
     return block_type in ['Paragraph', 'IndentedCode', 'FencedCode']
 
 
+def percent_encode(s, charset='utf-8'):
+    """ Percent-encode every character of s, as the bytes of charset.
+    """
+    if isinstance(s, unicode):
+        s = s.encode(charset)
+    return ''.join(['%{0:02X}'.format(ord(b)) for b in s])
+
+
 def url_fix(s, charset='utf-8'):
     """
     Sometimes you get an URL by a user that just isn't a real
@@ -286,32 +562,50 @@ def url_fix(s, charset='utf-8'):
     handle data entered by the user:
 
     >>> url_fix(u'http://de.wikipedia.org/wiki/Elf (Begriffskl�rung)')
-    'http://de.wikipedia.org/wiki/Elf%20%28Begriffskl%C3%A4rung%29'
+    u'http://de.wikipedia.org/wiki/Elf%20%28Begriffskl%C3%A4rung%29'
 
-    :param charset: The target charset for the URL if the url was
-                    given as unicode string.
+    Text stays text: only the characters to be percent-encoded are
+    encoded, and URLs with none are returned as they are.
+
+    :param charset: The charset of the percent-encoded bytes of
+                    characters in a unicode URL.
     """
-#     print 'URL', s
-    if isinstance(s, unicode):
-        s = s.encode(charset, 'ignore')
-    scheme, netloc, path, qs, anchor = urlparse.urlsplit(s)
-#     print 'BEFORE', scheme, '|', netloc, '|', path, '|', qs, '|', anchor
+    if reSafeUrl.match(s):
+        return s
+    try:
+        scheme, netloc, path, qs, anchor = urlparse.urlsplit(s)
+    except ValueError:
+        # urlsplit rejects some malformed hosts, like 'http://[x'.
+        return s
     if scheme in ['mailto']:
         return s
     else:
-        netloc = urllib.quote(netloc, ':')
-        path = urllib.quote(path, '/%()*:')
-        qs = urllib.quote_plus(qs, ':&=*')
-#         print 'AFTER', scheme, '|', netloc, '|', path, '|', qs, '|', anchor
+        netloc = reUnsafeNetloc.sub(lambda m: percent_encode(m.group(0), charset), netloc)
+        path = reUnsafePath.sub(lambda m: percent_encode(m.group(0), charset), path)
+        qs = reUnsafeQuery.sub(lambda m: percent_encode(m.group(0), charset).replace('%20', '+'), qs)
         return urlparse.urlunsplit((scheme, netloc, path, qs, anchor))
 
 
 class Dumper(object):
     """ Debug printer. """
+    __slots__ = ()
+
+    def attributes(self):
+        """
+        Return a dict of the instance's attributes, whether kept in its
+        __dict__ or in slots.
+        
+        """
+        d = dict(getattr(self, '__dict__', ()))
+        for cls in type(self).__mro__:
+            for k in getattr(cls, '__slots__', ()):
+                if hasattr(self, k):
+                    d[k] = getattr(self, k)
+        return d
 
     def dump(self):
         d = {}
-        for k, v in self.__dict__.items():
+        for k, v in self.attributes().items():
             if k == 'parent':
                 d[k] = v
             elif isinstance(v, list):
@@ -320,67 +614,507 @@ class Dumper(object):
                 d[k] = v.dump() if hasattr(v, 'dump') else v
         return (self.__class__.__name__, d)
 
+    # Pickle protocols 0 and 1 can't save slots by themselves.
+    def __getstate__(self):
+        return Dumper.attributes(self)
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
 
 
 class Block(Dumper):
+    # Blocks change type while parsing (a Paragraph can become a
+    # SetextHeader or a ReferenceDef), so there is one class for all of
+    # them, with slots for the attributes of every type.
+    __slots__ = (
+        'tag', 't', 'open', 'last_line_blank', 'start_line', 'end_line',
+        'start_column', 'inline_content', 'string_content', 'strings',
+        'children', 'parent', 'tight', 'info', 'level', 'list_data',
+        'fence_char', 'fence_length', 'fence_offset', 'reference_definitions',
+        'missing_references',
+    )
 
-    def __init__(self):
+    def __init__(self, t='', start_line=None, start_column=None):
         super(Block, self).__init__()
         self.tag = ''
-        self.t = ''
+        self.t = t
         self.open = True
         self.last_line_blank = False
-        self.start_line = None
-        self.end_line = None
-        self.start_column = None
+        self.start_line = start_line
+        self.end_line = start_line
+        self.start_column = start_column
         self.inline_content = []
+        # strings holds (buf, start, end) spans of the lines of the block,
+        # which finalize turns into string_content.
         self.string_content = ''
         self.strings = []
         self.children = []
+        self.parent = None
         self.tight = False
         self.info = ''
+        self.level = None
+        self.list_data = None
+        self.fence_char = None
+        self.fence_length = None
+        self.fence_offset = None
+        # (label, link) pairs of the reference definitions that began the
+        # block, in document order.
+        self.reference_definitions = []
+        # Set by DocParser.iter_parse on a block waiting for definitions.
+        self.missing_references = None
 
     @staticmethod
     def makeBlock(tag, start_line, start_column):
-        block = Block()
-        block.t = tag
-        block.open = True
-        block.last_line_blank = False
-        block.start_line = start_line
-        block.start_column = start_column
-        block.end_line = start_line
-        block.children = []
-        block.parent = None
-        # string_content is formed by concatenating strings, in finalize.
-        block.string_content = ''
-        block.strings = []
-        block.inline_content = []
-        return block
+        return Block(tag, start_line, start_column)
 
 
 class Inline(Dumper):
+    """
+    Base class of the inline nodes.  Each type of inline is a subclass
+    setting t; c holds a string, or a list of inlines for Emph and Strong.
+    
+    """
+    __slots__ = ('c',)
+    t = None
 
-    def __init__(self, c=None, t=None, **kwargs):
+    def __init__(self, c=None):
         super(Inline, self).__init__()
         self.c = c
-        self.t = t
-        for k, v in kwargs.items():
-            setattr(self, k, v)
+
+    def attributes(self):
+        d = super(Inline, self).attributes()
+        d['t'] = self.t
+        return d
+
+
+class Str(Inline):
+    __slots__ = ()
+    t = 'Str'
+
+
+class Code(Inline):
+    __slots__ = ()
+    t = 'Code'
+
+
+class Html(Inline):
+    __slots__ = ()
+    t = 'Html'
+
+
+class Entity(Inline):
+    __slots__ = ()
+    t = 'Entity'
+
+
+class Hardbreak(Inline):
+    __slots__ = ()
+    t = 'Hardbreak'
+
+
+class Softbreak(Inline):
+    __slots__ = ()
+    t = 'Softbreak'
+
+
+class Emph(Inline):
+    __slots__ = ()
+    t = 'Emph'
+
+
+class Strong(Inline):
+    __slots__ = ()
+    t = 'Strong'
+
+
+class Link(Inline):
+    """
+    A link to destination.  Without a label it is the target of a
+    reference definition, as stored in a refmap.
+    
+    """
+    __slots__ = ('destination', 'title', 'label')
+    t = 'Link'
+
+    def __init__(self, destination, title, label=None):
+        super(Link, self).__init__()
+        self.destination = destination
+        self.title = title
+        self.label = label
+
+
+class Image(Link):
+    __slots__ = ()
+    t = 'Image'
+
+
+# Type codes of the nodes in a NodeTable.
+NODE_TYPES = [
+    'Document', 'BlockQuote', 'List', 'ListItem', 'Paragraph', 'ATXHeader',
+    'SetextHeader', 'IndentedCode', 'FencedCode', 'HtmlBlock',
+    'HorizontalRule', 'ReferenceDef',
+    'Str', 'Code', 'Html', 'Entity', 'Hardbreak', 'Softbreak', 'Emph',
+    'Strong', 'Link', 'Image',
+]
+NODE_CODES = dict((t, code) for code, t in enumerate(NODE_TYPES))
+INLINE_CLASSES = dict((cls.t, cls) for cls in [
+    Str, Code, Html, Entity, Hardbreak, Softbreak, Emph, Strong, Link, Image])
+
+# Blocks whose children in a NodeTable are their inlines.
+INLINE_CONTAINERS = frozenset(['Paragraph', 'ATXHeader', 'SetextHeader'])
+
+# NodeTable flags of lists and list items.
+TIGHT = 1
+ORDERED = 2
+
+
+class NodeTable(Dumper):
+    """
+    A document stored as parallel arrays indexed by node number, instead
+    of a graph of Block and Inline objects.  Node 0 is the document.  The
+    children of a Paragraph or header are its inlines, those of Emph and
+    Strong their contents and those of Link and Image their label.
+    Literal text is kept in one buffer, text, addressed by spans.
+    
+    """
+
+    def __init__(self):
+        super(NodeTable, self).__init__()
+        self.types = array('B')
+        self.parents = array('i')
+        self.first_children = array('i')
+        self.next_siblings = array('i')
+        self.start_lines = array('i')
+        self.start_columns = array('i')
+        self.end_lines = array('i')
+        # Span of the content of a Str, Code, Html or Entity inline or of a
+        # block, or of the destination of a Link or Image.
+        self.text_starts = array('i')
+        self.text_ends = array('i')
+        # Span of the title of a Link or Image, the info string of a
+        # FencedCode, or the bullet or delimiter of a list or list item.
+        self.extra_starts = array('i')
+        self.extra_ends = array('i')
+        # Header level, or start number of a list or list item (-1 if none).
+        self.values = array('i')
+        # TIGHT and ORDERED, for lists and list items.
+        self.flags = array('B')
+        self.text = u''
+        # Only used while building the table.
+        self.pieces = []
+        self.length = 0
+        self.last_children = []
+
+    def __len__(self):
+        return len(self.types)
+
+    def add_text(self, s):
+        """
+        Append s to the text buffer and return its span.
+        
+        """
+        start = self.length
+        if s:
+            self.pieces.append(s)
+            self.length += len(s)
+        return start, self.length
+
+    def add_node(self, t, parent, start_line=0, start_column=0, end_line=0, text=u'', extra=u'',
+                 value=0, flags=0):
+        """
+        Append a node as the last child of parent (-1 for the root) and
+        return its number.
+        
+        """
+        index = len(self.types)
+        self.types.append(NODE_CODES[t])
+        self.parents.append(parent)
+        self.first_children.append(-1)
+        self.next_siblings.append(-1)
+        self.last_children.append(-1)
+        if parent >= 0:
+            last = self.last_children[parent]
+            if last < 0:
+                self.first_children[parent] = index
+            else:
+                self.next_siblings[last] = index
+            self.last_children[parent] = index
+        self.start_lines.append(start_line)
+        self.start_columns.append(start_column)
+        self.end_lines.append(end_line)
+        start, end = self.add_text(text)
+        self.text_starts.append(start)
+        self.text_ends.append(end)
+        start, end = self.add_text(extra)
+        self.extra_starts.append(start)
+        self.extra_ends.append(end)
+        self.values.append(value)
+        self.flags.append(flags)
+        return index
+
+    def add_block(self, block, parent):
+        """
+        Append a block, with everything below it, as the last child of
+        parent and return its number.
+        
+        """
+        first = len(self.types)
+        stack = [(block, parent)]
+        while stack:
+            node, parent = stack.pop()
+            if isinstance(node, Block):
+                extra = node.info
+                value = node.level or 0
+                flags = 0
+                data = node.list_data
+                if data is not None:
+                    extra = data.bullet_char or data.delimiter or u''
+                    value = -1 if data.start is None else data.start
+                    flags = (TIGHT if node.tight else 0) | (ORDERED if data.type == 'Ordered' else 0)
+                index = self.add_node(node.t, parent, node.start_line, node.start_column,
+                                      node.end_line, node.string_content, extra, value, flags)
+                children = node.inline_content if node.t in INLINE_CONTAINERS else node.children
+            elif isinstance(node, Link):
+                index = self.add_node(node.t, parent, text=node.destination, extra=node.title)
+                children = node.label
+            elif node.t in ['Emph', 'Strong']:
+                index = self.add_node(node.t, parent)
+                children = node.c
+            else:
+                index = self.add_node(node.t, parent, text=node.c)
+                children = ()
+            stack.extend((child, index) for child in reversed(children))
+        return first
+
+    def finish(self):
+        """
+        Join the text buffer once all the nodes have been added.
+        
+        """
+        self.text = u''.join(self.pieces)
+        self.pieces = []
+        self.last_children = []
+
+    @staticmethod
+    def from_block(block):
+        """
+        Flatten a parsed document (or any block) into a new table.
+        
+        """
+        table = NodeTable()
+        table.add_block(block, -1)
+        table.finish()
+        return table
+
+    def node(self, index=0):
+        return TableNode(self, index)
+
+    def child_numbers(self, index):
+        """
+        Return the numbers of the children of a node, in order.
+        
+        """
+        result = []
+        child = self.first_children[index]
+        while child >= 0:
+            result.append(child)
+            child = self.next_siblings[child]
+        return result
+
+    def span_text(self, starts, ends, index):
+        return self.text[starts[index]:ends[index]]
+
+    def to_block(self, index=0):
+        """
+        Convert the node at index and everything below it back into Block
+        and Inline objects.  State only used while parsing, like the lines
+        of a block, is not kept in the table.
+        
+        """
+        result = []
+        stack = [(index, result, None)]
+        while stack:
+            index, siblings, parent = stack.pop()
+            t = NODE_TYPES[self.types[index]]
+            text = self.span_text(self.text_starts, self.text_ends, index)
+            extra = self.span_text(self.extra_starts, self.extra_ends, index)
+            if t in INLINE_CLASSES:
+                cls = INLINE_CLASSES[t]
+                if issubclass(cls, Link):
+                    node = cls(text, extra, [])
+                    children = node.label
+                elif t in ['Emph', 'Strong']:
+                    node = cls([])
+                    children = node.c
+                else:
+                    node = cls(None if t in ['Hardbreak', 'Softbreak'] else text)
+                    children = None
+            else:
+                node = Block(t, self.start_lines[index], self.start_columns[index])
+                node.end_line = self.end_lines[index]
+                node.open = False
+                node.parent = parent
+                node.string_content = text
+                if t in ['ATXHeader', 'SetextHeader']:
+                    node.level = self.values[index]
+                elif t == 'FencedCode':
+                    node.info = extra
+                elif t in ['List', 'ListItem']:
+                    flags = self.flags[index]
+                    node.tight = bool(flags & TIGHT)
+                    data = node.list_data = ListData()
+                    if flags & ORDERED:
+                        data.type = 'Ordered'
+                        data.delimiter = extra
+                    else:
+                        data.type = 'Bullet'
+                        data.bullet_char = extra
+                    if self.values[index] >= 0:
+                        data.start = self.values[index]
+                children = node.inline_content if t in INLINE_CONTAINERS else node.children
+            siblings.append(node)
+            stack.extend((child, children, node) for child in reversed(self.child_numbers(index)))
+        return result[0]
+
+
+class TableNode(object):
+    """
+    A view of one node of a NodeTable with the attributes of the Block or
+    Inline it stands for, so a table can be rendered like a tree.
+    
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def child_nodes(self):
+        return [TableNode(self.table, child) for child in self.table.child_numbers(self.index)]
+
+    @property
+    def t(self):
+        return NODE_TYPES[self.table.types[self.index]]
+
+    @property
+    def children(self):
+        return [] if self.t in INLINE_CONTAINERS else self.child_nodes()
+
+    @property
+    def inline_content(self):
+        return self.child_nodes() if self.t in INLINE_CONTAINERS else []
+
+    @property
+    def label(self):
+        return self.child_nodes()
+
+    @property
+    def c(self):
+        if self.t in ['Emph', 'Strong']:
+            return self.child_nodes()
+        return self.string_content
+
+    @property
+    def string_content(self):
+        return self.table.span_text(self.table.text_starts, self.table.text_ends, self.index)
+
+    destination = string_content
+
+    @property
+    def title(self):
+        return self.table.span_text(self.table.extra_starts, self.table.extra_ends, self.index)
+
+    info = title
+
+    @property
+    def level(self):
+        return self.table.values[self.index]
+
+    @property
+    def tight(self):
+        return bool(self.table.flags[self.index] & TIGHT)
+
+    @property
+    def list_data(self):
+        data = ListData()
+        data.type = 'Ordered' if self.table.flags[self.index] & ORDERED else 'Bullet'
+        start = self.table.values[self.index]
+        data.start = None if start < 0 else start
+        return data
+
+    @property
+    def start_line(self):
+        return self.table.start_lines[self.index]
+
+    @property
+    def start_column(self):
+        return self.table.start_columns[self.index]
+
+    @property
+    def end_line(self):
+        return self.table.end_lines[self.index]
+
+
+# Result of InlineParser.scan_delims.
+DelimRun = namedtuple('DelimRun', ['numdelims', 'can_open', 'can_close'])
+
+
+class Delimiter(Dumper):
+    """
+    An entry on the InlineParser delimiter stack: an emphasis opener
+    waiting for its closer.
+    
+    """
+
+    def __init__(self, c, numdelims, delimpos):
+        super(Delimiter, self).__init__()
+        self.c = c
+        self.numdelims = numdelims
+        # Index of the opener's literal Str inline.
+        self.delimpos = delimpos
+        # Only used by *** and ___ openers: index and size of the first
+        # closer, which may close either the inner Emph or Strong.
+        self.first_close = 0
+        self.first_close_delims = 0
 
 
 class InlineParser(Dumper):
     """
     An InlineParser keeps track of a subject (a string to be
-    parsed) and a position in that subject.
+    parsed) and a position in that subject.  Parsing stops at end,
+    which is only short of the end of the subject while parsing the
+    contents of a link label.
     
     """
 
     def __init__(self):
         super(InlineParser, self).__init__()
         self.subject = ''
-        self.label_nest_level = 0
         self.pos = 0
+        self.end = 0
         self.refmap = dict()
+        self.delimiters = []
+        # Maps the position of each scanned '[' to the position of its
+        # matching ']', or None if it has none.
+        self.brackets = dict()
+        # Built lazily by index_backticks.
+        self.backtick_runs = None
+        # If set, the normalized label of every reference link looked up
+        # in the refmap, found or not, is added to it.
+        self.reference_labels = None
+        # A ParseStats counting calls to match, if any.
+        self.stats = None
+        # Limits set by DocParser: the number of emphasis openers and link
+        # labels that may be open at once, beyond which they are left as
+        # literal text, and the time limit with the default_timer() value
+        # it runs out at.
+        self.max_depth = None
+        self.time_limit = None
+        self.deadline = None
+        # The number of openers and labels around the label being parsed.
+        self.depth = 0
 
     def match(self, regex):
         """
@@ -388,9 +1122,11 @@ class InlineParser(Dumper):
         position in subject and return the match otherwise return None.
         
         """
-        m = regex.search(self.subject[self.pos:])
+        if self.stats is not None:
+            self.stats.count_regex('inline')
+        m = regex.match(self.subject, self.pos, self.end)
         if m:
-            self.pos += (m.start() + len(m.group(0)))
+            self.pos = m.end()
             return m.group(0)
         else:
             return None
@@ -400,17 +1136,16 @@ class InlineParser(Dumper):
         Returns the character at the current subject position, or None if
         there are no more characters.
         """
-        try:
+        if self.pos < self.end:
             return self.subject[self.pos]
-        except IndexError:
-            return None
+        return None
 
 
     def spnl(self):
         """
         Parse zero or more space characters, including at most one newline.
         """
-        self.match(re.compile(r'^ *(?:\n *)?'))
+        self.match(reSpnl)
         return 1
 
     def parse_backticks(self, inlines):
@@ -425,28 +1160,43 @@ class InlineParser(Dumper):
         
         """
         startpos = self.pos
-        ticks = self.match(re.compile(r'^`+'))
+        ticks = self.match(reTicks)
         if not ticks:
             return 0
 
         after_open_ticks = self.pos
 
-        match = self.match(re.compile(r'`+', re.M))
-        while match:
-            if match == ticks:
-                inline = Inline(
-                    t='Code',
-                    c=re.sub(r'[ \n]+', ' ', self.subject[after_open_ticks:(self.pos - len(ticks))]).strip(),
-                )
-                inlines.append(inline)
-                return self.pos - startpos
-
-            match = self.match(re.compile(r'`+', re.M))
+        # The closer is the next run of exactly as many backticks.
+        if self.backtick_runs is None:
+            self.index_backticks()
+        numticks = len(ticks)
+        starts = self.backtick_runs.get(numticks, [])
+        i = bisect.bisect_left(starts, after_open_ticks)
+        if i < len(starts) and starts[i] + numticks <= self.end:
+            inlines.append(Code(
+                reCodeSpanWhitespace.sub(' ', self.subject[after_open_ticks:starts[i]]).strip()))
+            self.pos = starts[i] + numticks
+            return self.pos - startpos
 
-        inlines.append(Inline(t='Str', c=ticks))
-        self.pos = after_open_ticks
+        inlines.append(Str(ticks))
         return self.pos - startpos
 
+    def index_backticks(self):
+        """
+        Build an index of the backtick runs in the subject, mapping the
+        length of each run to the sorted list of positions where runs of
+        that length start.  This is done once per subject, so finding the
+        closer for a code span (or learning there is none) never rescans
+        the rest of the subject.
+        
+        """
+        runs = dict()
+        if self.stats is not None:
+            self.stats.count_regex('inline')
+        for match in reTicks.finditer(self.subject):
+            runs.setdefault(match.end() - match.start(), []).append(match.start())
+        self.backtick_runs = runs
+
 
 
     def parse_escaped(self, inlines):
@@ -459,18 +1209,18 @@ class InlineParser(Dumper):
         subj = self.subject
         pos = self.pos
         if subj[pos] == '\\':
-            if pos < len(subj) - 1:
+            if pos < self.end - 1:
                 if subj[pos + 1] == '\n':
-                    inlines.append(Inline(t='Hardbreak'))
+                    inlines.append(Hardbreak())
                     self.pos = self.pos + 2
                     return 2
                 elif RE_ESCAPABLE.search(subj[pos + 1]):
-                    inlines.append(Inline(t='Str', c=subj[pos + 1]))
+                    inlines.append(Str(subj[pos + 1]))
                     self.pos = self.pos + 2
                     return 2
 
             self.pos += 1
-            inlines.append(Inline(t='Str', c='\\'))
+            inlines.append(Str('\\'))
             return 1
 
         else:
@@ -481,53 +1231,21 @@ class InlineParser(Dumper):
         """ Attempt to parse an autolink (URL or email in pointy brackets).        
         """
         dest = None
-        m = self.match(re.compile(r'^<([a-zA-Z0-9.!#$%&\'*+\\/=?^_`{|}~-]+@[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?(?:\.[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*)>'))
+        m = self.match(reEmailAutolink)
         if m:
             dest = m[1:-1]
-            inlines.append(
-                Inline(
-                    t='Link',
-                    label=[Inline(t='Str', c=dest)],
-                    destination='mailto:' + dest,
-                    title='',
-                )
-            )
+            inlines.append(Link('mailto:' + dest, '', [Str(dest)]))
             return len(m)
 
         else:
-            keys = [
-                'coap', 'doi', 'javascript', 'aaa', 'aaas', 'about', 'acap',
-                'cap', 'cid', 'crid', 'data', 'dav', 'dict', 'dns', 'file',
-                'ftp', 'geo', 'go', 'gopher', 'h323', 'http', 'https', 'iax',
-                'icap', 'im', 'imap', 'info', 'ipp', 'iris', 'iris.beep',
-                'iris.xpc', 'iris.xpcs', 'iris.lwz', 'ldap', 'mailto', 'mid',
-                'msrp', 'msrps', 'mtqp', 'mupdate', 'news', 'nfs', 'ni',
-                'nih', 'nntp', 'opaquelocktoken', 'pop', 'pres', 'rtsp',
-                'service', 'session', 'shttp', 'sieve', 'sip', 'sips', 'sms',
-                'snmp', 'soap.beep', 'soap.beeps', 'tag', 'tel', 'telnet',
-                'tftp', 'thismessage', 'tn3270', 'tip', 'tv', 'urn', 'vemmi',
-                'ws', 'wss', 'xcon', 'xcon-userid', 'xmlrpc.beep',
-                'xmlrpc.beeps', 'xmpp', 'z39.50r', 'z39.50s', 'adiumxtra',
-                'afp', 'afs', 'aim', 'apt', 'attachment', 'aw', 'beshare',
-                'bitcoin', 'bolo', 'callto', 'chrome', 'chrome-extension',
-                'com-eventbrite-attendee', 'content', 'cvs', 'dlna-playsingle',
-                'dlna-playcontainer', 'dtn', 'dvb', 'ed2k', 'facetime',
-                'feed', 'finger', 'fish', 'gg', 'git', 'gizmoproject', 'gtalk',
-                'hcp', 'icon', 'ipn', 'irc', 'irc6', 'ircs', 'itms', 'jar',
-                'jms', 'keyparc', 'lastfm', 'ldaps', 'magnet', 'maps',
-                'market', 'message', 'mms', 'ms-help', 'msnim', 'mumble',
-                'mvn', 'notes', 'oid', 'palm', 'paparazzi', 'platform',
-                'proxy', 'psyc', 'query', 'res', 'resource', 'rmi', 'rsync',
-                'rtmp', 'secondlife', 'sftp', 'sgn', 'skype', 'smb', 'soldat',
-                'spotify', 'ssh', 'steam', 'svn', 'teamspeak', 'things',
-                'udp', 'unreal', 'ut2004', 'ventrilo', 'view-source',
-                'webcal', 'wtai', 'wyciwyg', 'xfire', 'xri', 'ymsgr',
-            ]
-            m = self.match(re.compile(r'^<(?:{0}):[^<>\x00-\x20]*>'.format('|'.join(keys)), re.I))
-            if m:
-                dest = m[1:-1]
-                inlines.append(Inline(t='Link', label=[Inline(t='Str', c=dest)], destination=dest, title=''))
-                return len(m)
+            if self.stats is not None:
+                self.stats.count_regex('inline')
+            m = reAutolink.match(self.subject, self.pos, self.end)
+            if m and m.group(1).lower() in AUTOLINK_SCHEMES:
+                self.pos = m.end()
+                dest = m.group(0)[1:-1]
+                inlines.append(Link(dest, '', [Str(dest)]))
+                return len(m.group(0))
 
             else:
                 return 0
@@ -537,7 +1255,7 @@ class InlineParser(Dumper):
         """
         m = self.match(reHtmlTag)
         if m:
-            inlines.append(Inline(t='Html', c=m))
+            inlines.append(Html(m))
             return len(m)
         else:
             return 0
@@ -561,129 +1279,114 @@ class InlineParser(Dumper):
 
         char_after = self.peek() or '\n'
 
-        can_open = numdelims > 0 and numdelims <= 3 and not re.search(r'\s', char_after)
-        can_close = numdelims > 0 and numdelims <= 3 and not re.search(r'\s', char_before)
-        if c == '_':
-            can_open = can_open and not re.search(r'[a-z0-9]', char_before, re.I)
-            can_close = can_close and not re.search(r'[a-z0-9]', char_after, re.I)
+        can_open = can_close = numdelims > 0 and numdelims <= 3
+        if can_open:
+            can_open = not reWhitespaceChar.match(char_after)
+            can_close = not reWhitespaceChar.match(char_before)
+            if c == '_':
+                can_open = not reAsciiAlnum.match(char_before) and can_open
+                can_close = not reAsciiAlnum.match(char_after) and can_close
+            if self.stats is not None:
+                self.stats.count_regex('inline', 4 if c == '_' else 2)
 
         # Rewind pos.
         self.pos = startpos
-        return {'numdelims': numdelims, 'can_open': can_open, 'can_close': can_close}
+        return DelimRun(numdelims, can_open, can_close)
 
     def parse_emphasis(self, inlines):
         """
-        Attempt to parse emphasis or strong emphasis in an efficient way,
-        with no backtracking.
+        Attempt to parse an emphasis opener.  The delimiters are added to
+        inlines as a literal string; if they can open emphasis they are also
+        pushed onto the delimiter stack, and close_emphasis will convert the
+        string to Emph or Strong when a matching closer is reached.
         
         """
-        startpos = self.pos
-        c = None
-        first_close = 0
-        nxt = self.peek()
-
-        if nxt == '*' or nxt == '_':
-            c = nxt
-        else:
+        c = self.peek()
+        if c != '*' and c != '_':
             return 0
 
-        # Get opening delimiters.
         res = self.scan_delims(c)
-        self.pos += res['numdelims']
+        self.pos += res.numdelims
+        inlines.append(Str(self.subject[self.pos - res.numdelims:self.pos]))
+        if res.can_open and not self.too_deep():
+            self.delimiters.append(Delimiter(c, res.numdelims, len(inlines) - 1))
+        return res.numdelims
 
-        # We provisionally add a literal string.  If we match appropriate
-        # closing delimiters, we'll change this to Strong or Emph.
-        inlines.append(Inline(t='Str', c=self.subject[self.pos - res['numdelims']:self.pos]))
+    def too_deep(self):
+        """
+        Return True if no more emphasis or link labels may be opened
+        without going over max_depth.
+        
+        """
+        return self.max_depth is not None and self.depth + len(self.delimiters) >= self.max_depth
 
-        # Record the position of this opening delimiter
-        delimpos = len(inlines) - 1
+    def close_emphasis(self, inlines):
+        """
+        Attempt to close the innermost open emphasis with delimiters at the
+        current position.  Returns the number of delimiters consumed
+        (possibly 0).  Only the top of the delimiter stack is examined, so
+        each delimiter run costs a bounded amount of work.
+        
+        """
+        if not self.delimiters:
+            return 0
 
-        if not res['can_open'] or res['numdelims'] == 0:
+        opener = self.delimiters[-1]
+        res = self.scan_delims(opener.c)
+        if not res.can_close:
             return 0
+        delimpos = opener.delimpos
 
-        first_close_delims = 0
+        if opener.numdelims == 1:
+            self.pos += 1
+            # Convert the inline at delimpos, currently a string with the delim,
+            # into an Emph whose contents are the succeeding inlines.
+            inlines[delimpos] = Emph(inlines[delimpos + 1:])
+            splice(inlines, delimpos + 1)
+            self.delimiters.pop()
+            return 1
 
-        if res['numdelims'] == 1:
-            while True:
-                res = self.scan_delims(c)
-#                 pprint([i.dump() for i in inlines])
-#                 print 'RES', pformat(res)
-                if res['numdelims'] >= 1 and res['can_close']:
-                    self.pos += 1
-                    # Convert the inline at delimpos, currently a string with the delim,
-                    # into an Emph whose contents are the succeeding inlines.
-                    inlines[delimpos].t = 'Emph'
-                    inlines[delimpos].c = inlines[delimpos + 1:]
-                    splice(inlines, delimpos + 1)
-                    break
-                else:
-                    if self.parse_inline(inlines) == 0:
-                        break
-#             print 'END'
-#             pprint([i.dump() for i in inlines])
-            return self.pos - startpos
-
-        elif res['numdelims'] == 2:  # We started with ** or __
-            while True:
-                res = self.scan_delims(c)
-                if res['numdelims'] >= 2 and res['can_close']:
-                    self.pos += 2
-                    inlines[delimpos].t = 'Strong'
-                    inlines[delimpos].c = inlines[delimpos + 1:]
-                    splice(inlines, delimpos + 1)
-                    break
-                else:
-                    if self.parse_inline(inlines) == 0:
-                        break
-
-            return self.pos - startpos
-
-
-        elif res['numdelims'] == 3:
-            while True:
-                res = self.scan_delims(c)
-#                 print 'RES', res
-#                 print 'FCD', first_close_delims
-                if res['numdelims'] >= 1 and res['numdelims'] <= 3 and res['can_close'] and res['numdelims'] != first_close_delims:
-                    if first_close_delims == 1 and res['numdelims'] > 2:
-                        res['numdelims'] = 2
-                    elif first_close_delims == 2:
-                        res['numdelims'] = 1
-                    elif res['numdelims'] == 3:
-                        # If we opened with ***, then we interpret *** as ** followed by *
-                        # giving us <strong><em>
-                        res['numdelims'] = 1
-
-                    self.pos += res['numdelims']
-
-                    if first_close > 0:  # If we've already passed the first closer.
-                        inlines[delimpos].t = 'Strong' if first_close_delims == 1 else 'Emph'
-                        inlines[delimpos].c = [Inline(
-                            t='Emph' if first_close_delims == 1 else 'Strong',
-                            c=inlines[delimpos + 1:first_close],
-                        )]
-                        inlines[delimpos].c.extend(inlines[first_close + 1:])
-                        splice(inlines, delimpos + 1)
-                        break
-
-                    else:
-                        # This is the first closer for now, add literal string.
-                        # We'll change this when we hit the second closer.
-                        inlines.append(Inline(t='Str', c=self.subject[self.pos - res['numdelims']:self.pos]))
-#                         print 'Emph IL'
-#                         pprint([i.dump() for i in inlines])
-                        first_close = len(inlines) - 1
-                        first_close_delims = res['numdelims']
-                else:
-                    if self.parse_inline(inlines) == 0:
-                        break
-
-            return self.pos - startpos
+        elif opener.numdelims == 2:  # We started with ** or __
+            if res.numdelims < 2:
+                return 0
+            self.pos += 2
+            inlines[delimpos] = Strong(inlines[delimpos + 1:])
+            splice(inlines, delimpos + 1)
+            self.delimiters.pop()
+            return 2
+
+        # We started with *** or ___
+        first_close_delims = opener.first_close_delims
+        numdelims = res.numdelims
+        if numdelims == first_close_delims:
+            return 0
+        if first_close_delims == 1 and numdelims > 2:
+            numdelims = 2
+        elif first_close_delims == 2:
+            numdelims = 1
+        elif numdelims == 3:
+            # If we opened with ***, then we interpret *** as ** followed by *
+            # giving us <strong><em>
+            numdelims = 1
+
+        self.pos += numdelims
+
+        if opener.first_close > 0:  # If we've already passed the first closer.
+            first_close = opener.first_close
+            outer, inner = (Strong, Emph) if first_close_delims == 1 else (Emph, Strong)
+            inlines[delimpos] = outer([inner(inlines[delimpos + 1:first_close])])
+            inlines[delimpos].c.extend(inlines[first_close + 1:])
+            splice(inlines, delimpos + 1)
+            self.delimiters.pop()
 
         else:
-            return 1
+            # This is the first closer for now, add literal string.
+            # We'll change this when we hit the second closer.
+            inlines.append(Str(self.subject[self.pos - numdelims:self.pos]))
+            opener.first_close = len(inlines) - 1
+            opener.first_close_delims = numdelims
 
-        return 0
+        return numdelims
 
     def parse_link_title(self):
         """
@@ -715,68 +1418,95 @@ class InlineParser(Dumper):
             else:
                 return None
 
-    def parse_link_label(self):
+    def scan_brackets(self):
         """
-        Attempt to parse a link label, returning number of characters parsed.
+        Scan forward from the '[' at the current position to its matching
+        ']', keeping a stack of the nested '[' seen on the way.  The match
+        for each of them is recorded in self.brackets (None if there is
+        none), so no part of the subject is scanned twice for a label.
         
         """
-        if self.peek() != '[':
-            return 0
-
         startpos = self.pos
-        nest_level = 0
-        if self.label_nest_level > 0:
-            # If we've already checked to the end of this subject
-            # for a label, even with a different starting [, we
-            # know we won't find one here and we can just return.
-            # This avoids lots of backtracking.
-            # Note:  nest level 1 would be: [foo [bar]
-            #        nest level 2 would be: [foo [bar [baz]
-            self.label_nest_level -= 1
-            return 0
-
-        self.pos += 1  # Advance past [ char.
+        openers = []
         c = self.peek()
-        while c and (c != ']' or nest_level > 0):
-            if c == '`':
+        while c:
+            if c == '[':
+                if self.pos != startpos and self.pos in self.brackets:
+                    # Already scanned, skip straight past the nested label.
+                    closer = self.brackets[self.pos]
+                    if closer is None:
+                        break
+                    self.pos = closer + 1
+                else:
+                    openers.append(self.pos)
+                    self.pos += 1
+            elif c == ']':
+                self.brackets[openers.pop()] = self.pos
+                self.pos += 1
+                if not openers:
+                    break
+            elif c == '`':
                 self.parse_backticks([])
             elif c == '<':
                 self.parse_autolink([]) or self.parse_html_tag([]) or self.parse_string([])
-            elif c == '[':  # Nested []
-                nest_level += 1
-                self.pos += 1
-            elif c == ']':  # Nested []
-                nest_level -= 1
-                self.pos += 1
             elif c == '\\':
                 self.parse_escaped([])
             else:
                 self.parse_string([])
             c = self.peek()
 
-        if c == ']':
-            self.label_nest_level = 0
-            self.pos += 1  # Advance past ]
-            return self.pos - startpos
-        else:
-            if not c:
-                self.label_nest_level = nest_level
-            self.pos = startpos
+        for opener in openers:
+            self.brackets[opener] = None
+        self.pos = startpos
+
+    def parse_link_label(self):
+        """
+        Attempt to parse a link label, returning number of characters parsed.
+        
+        """
+        if self.peek() != '[':
+            return 0
+
+        startpos = self.pos
+        if startpos not in self.brackets:
+            self.scan_brackets()
+
+        closer = self.brackets[startpos]
+        if closer is None:
             return 0
+        self.pos = closer + 1  # Advance past ]
+        return self.pos - startpos
 
+    def parse_label_inlines(self, start, end):
+        """
+        Parse the contents of a link label, between start and end, as a
+        list of inlines.  The label is parsed in place, once, only after
+        the rest of the link has matched.
+        
+        """
+        saved = (self.pos, self.end, self.refmap, self.delimiters, self.reference_labels, self.depth)
+        # Note: Parse without a refmap we don't want links to resolve
+        # in nested brackets!
+        self.refmap = {}
+        self.reference_labels = None
+        self.depth += len(self.delimiters) + 1
+        try:
+            return self.parse_inlines(start, end)
+        finally:
+            self.pos, self.end, self.refmap, self.delimiters, self.reference_labels, self.depth = saved
 
     def parse_link(self, inlines):
         """ Attempt to parse a link.  If successful, add the link to inlines.
         """
 #         print 'PARSING LINK'
         startpos = self.pos
+        if self.too_deep():
+            return 0
 
         n = self.parse_link_label()
         if n == 0:
             return 0
 
-        rawlabel = self.subject[startpos:startpos + n]
-#         print 'RAWL', rawlabel
         # If we got this far, we've parse a label.
         # Try to parse an explicit link: [label](url "title")
         if self.peek() == '(':
@@ -787,67 +1517,66 @@ class InlineParser(Dumper):
 #                 print 'DEST', dest
                 if dest is not None and self.spnl():
                     # Make sure there's a space before the title
-                    match = re.search(r'^\s', self.subject[self.pos - 1])
+                    if self.stats is not None:
+                        self.stats.count_regex('inline')
+                    match = reWhitespaceChar.match(self.subject, self.pos - 1)
                     if match:
                         title = self.parse_link_title() or ''
                     else:
                         title = ''
-                    if self.spnl() and self.match(re.compile(r'^\)')):
-                        inlines.append(
-                            Inline(
-                                t='Link',
-                                destination=dest,
-                                title=title,
-                                label=parse_raw_label(rawlabel),
-                            )
-                        )
+                    if self.spnl() and self.peek() == ')':
+                        self.pos += 1
+                        inlines.append(Link(
+                            dest, title, self.parse_label_inlines(startpos + 1, startpos + n - 1)))
                         return self.pos - startpos
 
             self.pos = startpos
             return 0
 
         # If we're here, it wasn't an explicit link. Try to parse a reference link.
+        if not self.refmap and self.reference_labels is None:
+            self.pos = startpos
+            return 0
+
         # first, see if there's another label
         savepos = self.pos
         self.spnl()
         beforelabel = self.pos
-        n = self.parse_link_label()
-        if n == 2:
-            # Empty second label.
-            reflabel = rawlabel
-        elif n > 0:
-            reflabel = self.subject[beforelabel:beforelabel + n]
+        n2 = self.parse_link_label()
+        if n2 > 2:
+            labelpos, labellen = beforelabel, n2
         else:
-            self.pos = savepos
-            reflabel = rawlabel
+            # No second label, or an empty one: the first is the reference.
+            if n2 == 0:
+                self.pos = savepos
+            labelpos, labellen = startpos, n
+
+        # No definition has a label this long, so don't copy and normalize
+        # it: with nested brackets that would be done for each opener.
+        if labellen - 2 > MAX_LABEL_LENGTH:
+            self.pos = startpos
+            return 0
 
-        # Lookup rawlabel in refmap
-        link = self.refmap.get(normalize_reference(reflabel))
+        # Lookup the label in refmap
+        normlabel = normalize_reference(self.subject[labelpos:labelpos + labellen])
+        if self.reference_labels is not None:
+            self.reference_labels.add(normlabel)
+        link = self.refmap.get(normlabel)
         if link:
-            inlines.append(
-                Inline(
-                    t='Link',
-                    destination=link.destination,
-                    title=link.title,
-                    label=parse_raw_label(rawlabel),
-                )
-            )
+            inlines.append(Link(
+                link.destination, link.title, self.parse_label_inlines(startpos + 1, startpos + n - 1)))
             return self.pos - startpos
 
         else:
             self.pos = startpos
             return 0
 
-        # Nothing worked, rewind
-        self.pos = startpos
-        return 0
-
     def parse_entity(self, inlines):
         """ Attempt to parse an entity, adding to inlines if successful.
         """
-        m = self.match(re.compile(r'^&(?:#x[a-f0-9]{1,8}|#[0-9]{1,8}|[a-z][a-z0-9]{1,31});', re.I))
+        m = self.match(reEntity)
         if m:
-            inlines.append(Inline(t='Entity', c=unescape_html_entity(m)))
+            inlines.append(Entity(unescape_html_entity(m)))
             return len(m)
         else:
             return 0
@@ -861,9 +1590,9 @@ class InlineParser(Dumper):
         m = self.match(reMain)
         if m:
             if inlines and inlines[-1].t == 'Softbreak':
-                inlines.append(Inline(t='Str', c=m.lstrip()))
+                inlines.append(Str(m.lstrip()))
             else:
-                inlines.append(Inline(t='Str', c=m))
+                inlines.append(Str(m))
             return len(m)
         else:
             return 0
@@ -878,12 +1607,12 @@ class InlineParser(Dumper):
             self.pos += 1
             last = inlines[-1] if inlines else None
             if last and last.t == 'Str' and last.c[-2:] == '  ':
-                last.c = re.sub(r' *$', '', last.c)
-                inlines.append(Inline(t='Hardbreak'))
+                last.c = last.c.rstrip(' ')
+                inlines.append(Hardbreak())
             else:
                 if last and last.t == 'Str' and last.c[-1] == ' ':
                     last.c = last.c[:-1]
-                inlines.append(Inline(t='Softbreak'))
+                inlines.append(Softbreak())
 
             return 1
         else:
@@ -896,13 +1625,15 @@ class InlineParser(Dumper):
         by a link, add a literal '!' to inlines.
         
         """
-        if self.match(re.compile(r'^!')):
+        if self.peek() == '!':
+            self.pos += 1
             n = self.parse_link(inlines)
             if n == 0:
-                inlines.append(Inline(t='Str', c='!'))
+                inlines.append(Str('!'))
                 return 1
             elif inlines and inlines[-1] and inlines[-1].t == 'Link':
-                inlines[-1].t = 'Image'
+                link = inlines[-1]
+                inlines[-1] = Image(link.destination, link.title, link.label)
                 return n + 1
             else:
                 raise ParseError("Shouldn't happen: parsing Image.")
@@ -910,21 +1641,29 @@ class InlineParser(Dumper):
         else:
             return 0
 
-    def parse_reference(self, s, refmap):
-        """ Attempt to parse a link reference, modifying refmap.
+    def parse_reference(self, s, refmap, pos=0):
+        """
+        Attempt to parse a link reference starting at offset pos in s,
+        modifying refmap.
+        
         """
 #         print 'PARSING REFER', s
 
-        self.subject = s
-        self.pos = 0
+        if s is not self.subject:
+            self.subject = s
+            self.end = len(s)
+            self.brackets = {}
+            self.backtick_runs = None
+        self.pos = pos
         startpos = self.pos
 
         # Label
         match_chars = self.parse_link_label()
-        if match_chars == 0:
+        if match_chars == 0 or match_chars - 2 > MAX_LABEL_LENGTH:
+            self.pos = startpos
             return 0
         else:
-            rawlabel = self.subject[:match_chars]
+            rawlabel = self.subject[startpos:startpos + match_chars]
 
         # Colon
         if self.peek() == ':':
@@ -955,18 +1694,17 @@ class InlineParser(Dumper):
 
         # Text after title, not a reference definition.
 #         print 'AFTER REF', self.pos, repr(self.subject[self.pos:])
-        if len(self.subject) - 1 > self.pos:
-            for c in self.subject[self.pos:]:
-                if c == '\n':
-                    break
-                elif re.match(r'\S', c):
-                    self.pos = startpos
-                    return 0
+        if self.end - 1 > self.pos:
+            if self.stats is not None:
+                self.stats.count_regex('inline')
+            if not reSpaceToEndOfLine.match(self.subject, self.pos, self.end):
+                self.pos = startpos
+                return 0
 
         normlabel = normalize_reference(rawlabel)
 
         if normlabel not in refmap:
-            refmap[normlabel] = Inline(destination=dest, title=title)
+            refmap[normlabel] = Link(dest, title)
 #             print 'ADDING REF', normlabel, refmap[normlabel].dump()
 
         return self.pos - startpos
@@ -1008,17 +1746,34 @@ class InlineParser(Dumper):
 
         return r
 
+    def parse_inlines(self, start, end):
+        """
+        Parse the subject from start to end as a list of inlines, with a
+        fresh delimiter stack.
+        
+        """
+        self.pos = start
+        self.end = end
+        self.delimiters = []
+        inlines = []
+        deadline = self.deadline
+        while self.close_emphasis(inlines) or self.parse_inline(inlines):
+#             pprint([i.dump() for i in inlines])
+            if deadline is not None and default_timer() > deadline:
+                raise LimitExceeded('time_limit', self.time_limit)
+        # Openers left on the stack stay as literal strings.
+        self.delimiters = []
+        return inlines
+
     def parse(self, s, refmap):
         """ Parse s as a list of inlines, using refmap to resolve references.
         """
         self.subject = s
-        self.pos = 0
         self.refmap = refmap or {}
-        inlines = []
-        while self.parse_inline(inlines):
-#             pprint([i.dump() for i in inlines])
-            pass
-        return inlines
+        self.brackets = {}
+        self.backtick_runs = None
+        self.depth = 0
+        return self.parse_inlines(0, len(s))
 
 
 class ListData(Dumper):
@@ -1032,15 +1787,254 @@ class ListData(Dumper):
         self.padding = None
 
 
-class DocParser(Dumper):
+class MemoEntry(Dumper):
+    """
+    The inlines parsed from a block's content, the refmap entries they
+    depend on and the HTML rendered from them.
+    
+    """
+    __slots__ = ('inlines', 'references', 'html')
+
+    def __init__(self, inlines, references):
+        super(MemoEntry, self).__init__()
+        self.inlines = inlines
+        # (label, (destination, title) or None) for every reference label
+        # looked up while parsing.
+        self.references = references
+        # Maps (renderer class, block type, level, in tight list,
+        # softbreak) to HTML.
+        self.html = {}
+
+
+def reference_target(link):
+    return None if link is None else (link.destination, link.title)
+
+
+class BlockMemo(Dumper):
+    """
+    Memo table of the inlines and HTML of paragraphs and headers, shared
+    by a DocParser and an HtmlRenderer, so that blocks seen before (in
+    this or an earlier document) skip inline parsing and rendering.
+    Inlines are keyed on the block type, content and inline depth limit
+    and reused only if the refmap entries they looked up are unchanged;
+    HTML is keyed on the renderer class and options as well.  The least
+    recently used contents are dropped beyond max_entries, and the oldest
+    entries of a content beyond max_variants, one per set of refmap
+    entries.
+    
+    """
+
+    def __init__(self, max_entries=10000, max_variants=8):
+        super(BlockMemo, self).__init__()
+        self.max_entries = max_entries
+        self.max_variants = max_variants
+        # Maps (block type, content, max depth) to its MemoEntry list,
+        # oldest first.
+        self.entries = OrderedDict()
+        # Maps the id of each memoized inline list to its MemoEntry.
+        self.by_inlines = {}
+        self.hits = 0
+        self.misses = 0
+        self.render_hits = 0
+        self.render_misses = 0
+
+    def inlines(self, inline_parser, t, content, refmap):
+        """
+        Return the inlines of a block of type t with the given content,
+        parsing them with inline_parser unless they are memoized.
+        
+        """
+        key = (t, content, inline_parser.max_depth)
+        entries = self.entries.pop(key, [])
+        self.entries[key] = entries
+        outer_labels = inline_parser.reference_labels
+        for entry in entries:
+            if all(reference_target(refmap.get(label)) == target
+                   for label, target in entry.references):
+                self.hits += 1
+                break
+        else:
+            self.misses += 1
+            inline_parser.reference_labels = set()
+            try:
+                inlines = inline_parser.parse(content, refmap)
+                labels = inline_parser.reference_labels
+            finally:
+                inline_parser.reference_labels = outer_labels
+            entry = MemoEntry(inlines, tuple(
+                (label, reference_target(refmap.get(label))) for label in sorted(labels)))
+            entries.append(entry)
+            self.by_inlines[id(inlines)] = entry
+            if len(entries) > self.max_variants:
+                del self.by_inlines[id(entries.pop(0).inlines)]
+            while len(self.entries) > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                for old in evicted:
+                    del self.by_inlines[id(old.inlines)]
+
+        # Someone collecting labels (e.g. iter_parse) still needs these.
+        if outer_labels is not None:
+            outer_labels.update(label for label, _ in entry.references)
+        return entry.inlines
+
+    def render(self, renderer, block, in_tight_list):
+        """
+        Return the HTML of a paragraph or header, rendering it with
+        renderer unless its inlines came from this memo and have been
+        rendered the same way before.
+        
+        """
+        entry = self.by_inlines.get(id(block.inline_content))
+        if entry is None or entry.inlines is not block.inline_content:
+            return renderer.render_leaf(block, in_tight_list)
+        key = (type(renderer), block.t, block.level, in_tight_list, renderer.softbreak)
+        html = entry.html.get(key)
+        if html is None:
+            self.render_misses += 1
+            html = entry.html[key] = renderer.render_leaf(block, in_tight_list)
+        else:
+            self.render_hits += 1
+        return html
+
+
+class ParseStats(Dumper):
+    """
+    Timings and counters of DocParser and HtmlRenderer instances given
+    this object as stats.  Wall time is split into phases: block
+    structure ('block'), closing blocks ('finalize'), reference
+    definitions ('references'), inlines ('inline') and rendering
+    ('render'); time spent in a phase entered from another one only
+    counts for the inner phase.  Regex calls are counted by parser:
+    the line scans and block start matchers of the block parser
+    ('block') and every match the inline parser tries, including those
+    on reference definitions ('inline').  The substitutions run when
+    blocks are closed and when rendering are not counted.
+    
+    """
 
     def __init__(self):
+        super(ParseStats, self).__init__()
+        self.times = {}
+        self.lines = 0
+        self.blocks = {}
+        self.inlines = {}
+        self.regex_calls = {}
+        # [phase, time it was entered or resumed] for each phase entered.
+        self.phases = []
+
+    def enter(self, phase):
+        now = default_timer()
+        if self.phases:
+            outer = self.phases[-1]
+            self.times[outer[0]] = self.times.get(outer[0], 0.0) + now - outer[1]
+        self.phases.append([phase, now])
+
+    def leave(self):
+        now = default_timer()
+        phase, start = self.phases.pop()
+        self.times[phase] = self.times.get(phase, 0.0) + now - start
+        if self.phases:
+            self.phases[-1][1] = now
+
+    def count_regex(self, phase, n=1):
+        self.regex_calls[phase] = self.regex_calls.get(phase, 0) + n
+
+    def count_block(self, block):
+        self.blocks[block.t] = self.blocks.get(block.t, 0) + 1
+
+    def count_inlines(self, inlines):
+        stack = list(inlines)
+        while stack:
+            inline = stack.pop()
+            self.inlines[inline.t] = self.inlines.get(inline.t, 0) + 1
+            if isinstance(inline, Link):
+                stack.extend(inline.label)
+            elif isinstance(inline.c, list):
+                stack.extend(inline.c)
+
+    def as_dict(self):
+        """
+        Return the timings and counters as a dict of plain values.
+        
+        """
+        return {
+            'times': dict(self.times),
+            'lines': self.lines,
+            'blocks': dict(self.blocks),
+            'inlines': dict(self.inlines),
+            'regex_calls': dict(self.regex_calls),
+        }
+
+
+class DocParser(Dumper):
+
+    # Number of characters read at a time by parse_file, or bytes mapped
+    # at a time by parse_path.
+    chunk_size = 64 * 1024
+
+    def __init__(self, memo=None, stats=None, max_input_size=None, max_depth=None,
+                 max_inline_depth=None, time_limit=None):
         super(DocParser, self).__init__()
+        self.inlineParser = InlineParser()
+        self.top = 0
+        # A BlockMemo to reuse the inlines of blocks parsed before.
+        self.memo = memo
+        # A ParseStats to record timings and counters in, if any.
+        self.stats = stats
+        self.inlineParser.stats = stats
+        # Limits for untrusted input, None for no limit.  A document over
+        # max_input_size (bytes fed, or characters of text), nesting blocks
+        # more than max_depth deep or taking over time_limit seconds from
+        # its first input to parse raises LimitExceeded.  Emphasis and links nested more than
+        # max_inline_depth deep are left as literal text.
+        self.max_input_size = max_input_size
+        self.max_depth = max_depth
+        self.inlineParser.max_depth = max_inline_depth
+        self.inlineParser.time_limit = time_limit
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new document, discarding any state left from a previous
+        parse or from input fed with feed().
+        
+        """
         self.doc = Block.makeBlock('Document', 1, 1)
         self.tip = self.doc
+        # The chain of blocks from the document down to the tip, which
+        # are the open blocks while a line is being read.
+        self.open_blocks = [self.doc]
         self.refmap = dict()
-        self.inlineParser = InlineParser()
-        self.top = 0
+        # Text fed but not yet split into lines, chunks fed since the
+        # buffer was last scanned for line endings, and how much of the
+        # buffer is known to hold no complete line.
+        self.buffer = u''
+        self.pending = []
+        self.scanned = 0
+        # The number of the last line incorporated, and the offset of its
+        # start in the buffer it was read from.
+        self.line_number = 0
+        self.line_start = 0
+        # The blocks open before the current line that it didn't match.
+        self.unmatched_blocks = []
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        # The size of the input so far, and when the time limit runs out:
+        # the clock starts with the first input of the document.
+        self.input_size = 0
+        self.deadline = None
+        self.inlineParser.deadline = None
+
+    def start_clock(self):
+        """ Start the time limit of the document, if not started yet.
+        """
+        time_limit = self.inlineParser.time_limit
+        if time_limit is not None and self.deadline is None:
+            self.deadline = default_timer() + time_limit
+            self.inlineParser.deadline = self.deadline
+
+    def stop_clock(self):
+        self.deadline = None
+        self.inlineParser.deadline = None
 
     def break_out_of_lists(self, block, line_number):
         """
@@ -1050,13 +2044,12 @@ class DocParser(Dumper):
         break of of all lists" feature.)        
         
         """
-        b = block
         last_list = None
-        while True:
+        for b in self.open_blocks:
             if b.t == 'List':
                 last_list = b
-            b = b.parent
-            if not b:
+                break
+            if b is block:
                 break
 
         if last_list:
@@ -1065,21 +2058,35 @@ class DocParser(Dumper):
                 block = block.parent
 
             self.finalize(last_list, line_number)
-            self.tip = last_list.parent
+            self.set_tip(last_list.parent)
+
+    def set_tip(self, block):
+        """
+        Make block the tip, rebuilding the chain of open blocks down to it.
+        Only needed when a block other than the tip is finalized.
+        
+        """
+        self.tip = block
+        chain = []
+        while block:
+            chain.append(block)
+            block = block.parent
+        chain.reverse()
+        self.open_blocks[:] = chain
 
 
 
 
-    def add_line(self, line, offset):
+    def add_line(self, buf, offset, end):
         """
-        Add a line to the block at the tip.  We assume the tip
-        can accept lines -- that check should be done before calling this.
+        Add the line buf[offset:end] to the block at the tip, as a span.
+        We assume the tip can accept lines -- that check should be done
+        before calling this.
         
         """
-        s = line[offset:]
         if not self.tip.open:
-            raise ParseError('Attempted to add line ({0}) to closed container.'.format(line))
-        self.tip.strings.append(s)
+            raise ParseError('Attempted to add line ({0}) to closed container.'.format(buf[offset:end]))
+        self.tip.strings.append((buf, offset, end))
 
     def add_child(self, tag, line_number, offset):
         """
@@ -1091,13 +2098,143 @@ class DocParser(Dumper):
         while not can_contain(self.tip.t, tag):
             self.finalize(self.tip, line_number)
 
-        column_number = offset + 1  # Offset 0 = column 1
+        if self.max_depth is not None and len(self.open_blocks) > self.max_depth:
+            raise LimitExceeded('max_depth', len(self.open_blocks))
+
+        column_number = offset - self.line_start + 1  # Offset 0 = column 1
         new_block = Block.makeBlock(tag, line_number, column_number)
         self.tip.children.append(new_block)
         new_block.parent = self.tip
         self.tip = new_block
+        self.open_blocks.append(new_block)
         return new_block
 
+    def close_unmatched_blocks(self, line_number):
+        """
+        Finalize the blocks left open from the previous line that the
+        current line didn't match, innermost first.  This waits until a
+        block start is found or the line turns out not to be a lazy
+        paragraph continuation, which would keep them open.  Calls after
+        the first for a line do nothing.
+        
+        """
+        unmatched = self.unmatched_blocks
+        while unmatched:
+            self.finalize(unmatched.pop(), line_number)
+
+    # Block start matchers.  Each is tried on a line whose first non-space
+    # character, at first_nonspace, is indented less than a code block
+    # and is one block_starts lists it for.  It returns None if the line
+    # doesn't start its kind of block, or else the new container, the
+    # offset past the block start and True if no other block can start
+    # on the rest of the line.
+
+    def start_block_quote(self, container, buf, end, line_number, offset, first_nonspace, indent):
+        offset = first_nonspace + 1
+        # Optional following space
+        if offset < end and buf[offset] == ' ':
+            offset += 1
+        self.close_unmatched_blocks(line_number)
+        return self.add_child('BlockQuote', line_number, offset), offset, False
+
+    def start_atx_header(self, container, buf, end, line_number, offset, first_nonspace, indent):
+        if self.stats is not None:
+            self.stats.count_regex('block')
+        match = reATXHeaderMarker.match(buf, first_nonspace, end)
+        if not match:
+            return None
+        offset = first_nonspace + len(match.group(0))
+        self.close_unmatched_blocks(line_number)
+        container = self.add_child('ATXHeader', line_number, first_nonspace)
+        container.level = len(match.group(0).strip())  # Numver of #'s
+        # Remove trailing #'s
+        if self.stats is not None:
+            self.stats.count_regex('block')
+        match = reATXTrailingHashes.match(buf, offset, end)
+        container.strings = [(buf, match.start(1), match.end(1))]
+        return container, offset, True
+
+    def start_fenced_code(self, container, buf, end, line_number, offset, first_nonspace, indent):
+        if self.stats is not None:
+            self.stats.count_regex('block')
+        match = reCodeFence.match(buf, first_nonspace, end)
+        if not match:
+            return None
+        fence_length = len(match.group(0))
+        self.close_unmatched_blocks(line_number)
+        container = self.add_child('FencedCode', line_number, first_nonspace)
+        container.fence_length = fence_length
+        container.fence_char = match.group(0)[0]
+        container.fence_offset = first_nonspace - offset
+        return container, first_nonspace + fence_length, True
+
+    def start_html_block(self, container, buf, end, line_number, offset, first_nonspace, indent):
+        if self.stats is not None:
+            self.stats.count_regex('block')
+        if not reHtmlBlockOpen.match(buf, first_nonspace, end):
+            return None
+        self.close_unmatched_blocks(line_number)
+        container = self.add_child('HtmlBlock', line_number, first_nonspace)
+        # Note, we don't adjsut offset because the tag is part of the text
+        return container, offset, True
+
+    def start_setext_header(self, container, buf, end, line_number, offset, first_nonspace, indent):
+        if container.t != 'Paragraph' or len(container.strings) != 1:
+            return None
+        if self.stats is not None:
+            self.stats.count_regex('block')
+        match = reSetextHeaderLine.match(buf, first_nonspace, end)
+        if not match:
+            return None
+        self.close_unmatched_blocks(line_number)
+        container.t = 'SetextHeader'  # Convert Paragraph to SetextHeader
+        container.level = 1 if match.group(0)[0] == '=' else 2
+        return container, end, False
+
+    def start_horizontal_rule(self, container, buf, end, line_number, offset, first_nonspace, indent):
+        if self.stats is not None:
+            self.stats.count_regex('block')
+        if not reHrule.match(buf, first_nonspace, end):
+            return None
+        self.close_unmatched_blocks(line_number)
+        container = self.add_child('HorizontalRule', line_number, first_nonspace)
+        return container, end - 1, True
+
+    def start_list_item(self, container, buf, end, line_number, offset, first_nonspace, indent):
+        data = parse_list_marker(buf, first_nonspace, end, self.stats)
+        if not data:
+            return None
+        self.close_unmatched_blocks(line_number)
+        data.marker_offset = indent
+        offset = first_nonspace + data.padding
+
+        # Add the list if needed
+        if container.t != 'List' or not lists_match(container.list_data, data):
+            container = self.add_child('List', line_number, first_nonspace)
+            container.list_data = data
+
+        # Add the list item
+        container = self.add_child('ListItem', line_number, first_nonspace)
+        container.list_data = data
+        return container, offset, False
+
+    # The block start matchers to try, in order, for each first non-space
+    # character that can start a block.  Lines starting with any other
+    # character go straight to the paragraph path.
+    block_starts = dict.fromkeys('0123456789', (start_list_item,))
+    block_starts.update({
+        '>': (start_block_quote,),
+        '#': (start_atx_header,),
+        '`': (start_fenced_code,),
+        '~': (start_fenced_code,),
+        '<': (start_html_block,),
+        '=': (start_setext_header,),
+        '-': (start_setext_header, start_horizontal_rule, start_list_item),
+        '*': (start_horizontal_rule, start_list_item),
+        '_': (start_horizontal_rule,),
+        '+': (start_list_item,),
+    })
+
     def incorporate_line(self, line, line_number):
         """
         Analyze a line of text and update the document appropriately.
@@ -1105,39 +2242,57 @@ class DocParser(Dumper):
         then finalizing the document.        
         
         """
+        self.incorporate_span(line, 0, len(line), line_number)
+
+    def incorporate_span(self, buf, start, end, line_number):
+        """
+        Incorporate the line buf[start:end] without copying it out of buf.
+        Offsets into the line are offsets into buf, and blocks keep
+        (buf, start, end) spans of their lines until they are finalized.
+        
+        """
+        # Convert tabs to spaces.  Tab stops count from the start of the
+        # line, so a line with tabs is copied and scanned on its own.
+        if buf.find('\t', start, end) != -1:
+            buf = detab_line(buf[start:end])
+            start, end = 0, len(buf)
+        self.line_start = start
+
         all_matched = True
-        offset = 0
+        offset = start
         CODE_INDENT = 4
         container = self.doc
-        oldtip = self.tip
         blank = False
+        # Number of regex calls on the line outside the block start matchers
+        # (which count their own), for self.stats, and the offset of the last
+        # first non-space scan, whose result holds until offset moves.
+        scans = 0
+        scanned_offset = -1
 
-        # Convert tabs to spaces.
-        line = detab_line(line)
-
-        # For each containing block, try to parse the associated line start.
+        # For each open block, try to parse the associated line start.
         # Bail out on failure: container will point to the last matching block.
         # Set all_matched to false if not all containers match.
-        while container.children:
-            last_child = container.children[-1]
-            if not last_child.open:
-                break
-            container = last_child
-
-            match = match_at(re.compile(r'[^ ]'), line, offset)
+        open_blocks = self.open_blocks
+        depth = 1
+        while depth < len(open_blocks):
+            container = open_blocks[depth]
+
+            scans += 1
+            scanned_offset = offset
+            match = reNonSpace.search(buf, offset, end)
             if match is None:
-                first_nonspace = len(line)
+                first_nonspace = end
                 blank = True
             else:
-                first_nonspace = match
+                first_nonspace = match.start()
                 blank = False
             indent = first_nonspace - offset
 
             if container.t == 'BlockQuote':
-                matched = (indent <= 3 and first_nonspace < len(line) and line[first_nonspace] == '>')
+                matched = (indent <= 3 and first_nonspace < end and buf[first_nonspace] == '>')
                 if matched:
                     offset = first_nonspace + 1
-                    if offset < len(line) and line[offset] == ' ':
+                    if offset < end and buf[offset] == ' ':
                         offset += 1
                 else:
                     all_matched = False
@@ -1165,7 +2320,7 @@ class DocParser(Dumper):
             elif container.t == 'FencedCode':
                 # Skip optional spaces of fence offset.
                 i = container.fence_offset
-                while i > 0 and line[offset] == ' ':
+                while i > 0 and offset < end and buf[offset] == ' ':
                     offset += 1
                     i -= 1
 
@@ -1183,40 +2338,33 @@ class DocParser(Dumper):
             if not all_matched:
                 container = container.parent  # Back up to last matching block.
                 break
+            depth += 1
 
+        # Blocks not matched are closed by close_unmatched_blocks, once we
+        # know the line isn't a lazy paragraph continuation.
+        self.unmatched_blocks = open_blocks[depth:]
         last_matched_container = container
 
-        # This function is used to finalize and close any unmatched
-        # blocks.  We aren't ready to do this now, because we might
-        # have a lazy paragraph continuation, in which case we don't
-        # want to close unmatched blocks.  So we store this closure for
-        # use later, when we have more information.
-        def closeUnmatchedBlocks(mythis):
-            closeUnmatchedBlocks.oldtip = oldtip
-            # finalize any blocks not matched
-            while not closeUnmatchedBlocks.already_done and closeUnmatchedBlocks.oldtip != last_matched_container:
-                mythis.finalize(closeUnmatchedBlocks.oldtip, line_number)
-                closeUnmatchedBlocks.oldtip = closeUnmatchedBlocks.oldtip.parent
-            closeUnmatchedBlocks.already_done = True
-
-        closeUnmatchedBlocks.already_done = False
-
         # Check to see if we've hit 2nd blank line, if so break out of list.
         if blank and container.last_line_blank:
             self.break_out_of_lists(container, line_number)
 
         # Unless last matched container is a code block, try new container starts,
         # adding children to the last matched container.
+        block_starts = self.block_starts
         while (container.t not in ['FencedCode', 'IndentedCode', 'HtmlBlock'] and
-               match_at(re.compile(r'^[ #`~*+_=<>0-9-]'), line, offset) is not None):
-
-            match = match_at(re.compile(r'[^ ]'), line, offset)
-            if match is None:
-                first_nonspace = len(line)
-                blank = True
-            else:
-                first_nonspace = match
-                blank = False
+               offset < end and (buf[offset] == ' ' or buf[offset] in block_starts)):
+
+            if offset != scanned_offset:
+                scans += 1
+                scanned_offset = offset
+                match = reNonSpace.search(buf, offset, end)
+                if match is None:
+                    first_nonspace = end
+                    blank = True
+                else:
+                    first_nonspace = match.start()
+                    blank = False
 
             indent = first_nonspace - offset
 
@@ -1224,103 +2372,24 @@ class DocParser(Dumper):
                 # Indented code
                 if self.tip.t != 'Paragraph' and not blank:
                     offset += CODE_INDENT
-                    closeUnmatchedBlocks.already_done = False
-                    closeUnmatchedBlocks(self)
-                    oldtip = closeUnmatchedBlocks.oldtip
+                    self.close_unmatched_blocks(line_number)
                     container = self.add_child('IndentedCode', line_number, offset)
                 else:  # Indent > 4 in a lazy paragraph continuation.
                     break
 
-            elif first_nonspace < len(line) and line[first_nonspace] == '>':
-                # Blockquote
-                offset = first_nonspace + 1
-                # Optional following space
-                if offset < len(line) and line[offset] == ' ':
-                    offset += 1
-                closeUnmatchedBlocks.already_done = False
-                closeUnmatchedBlocks(self)
-                oldtip = closeUnmatchedBlocks.oldtip
-                container = self.add_child('BlockQuote', line_number, offset)
+            elif blank:
+                break
 
             else:
-                match = re.match(r'^#{1,6}(?: +|$)', line[first_nonspace:])
-                if match:
-                    # ATX Header
-                    offset = first_nonspace + len(match.group(0))
-                    closeUnmatchedBlocks.already_done = False
-                    closeUnmatchedBlocks(self)
-                    oldtip = closeUnmatchedBlocks.oldtip
-                    container = self.add_child('ATXHeader', line_number, first_nonspace)
-                    container.level = len(match.group(0).strip())  # Numver of #'s
-                    # Remove trailing #'s
-                    container.strings = [re.sub(r'(.*?)(?: *(?<!\\)#*)*$', '\g<1>', line[offset:])]
-                    break
-
-                else:
-                    match = re.match(r'^`{3,}(?!.*`)|^~{3,}(?!.*~)', line[first_nonspace:])
-                    if match:
-                        # Fenced code block
-                        fence_length = len(match.group(0))
-                        closeUnmatchedBlocks.already_done = False
-                        closeUnmatchedBlocks(self)
-                        oldtip = closeUnmatchedBlocks.oldtip
-                        container = self.add_child('FencedCode', line_number, first_nonspace)
-                        container.fence_length = fence_length
-                        container.fence_char = match.group(0)[0]
-                        container.fence_offset = first_nonspace - offset
-                        offset = first_nonspace + fence_length
-                        break
-
-                    elif match_at(reHtmlBlockOpen, line, first_nonspace) is not None:
-                        # Html block
-                        closeUnmatchedBlocks.already_done = False
-                        closeUnmatchedBlocks(self)
-                        oldtip = closeUnmatchedBlocks.oldtip
-                        container = self.add_child('HtmlBlock', line_number, first_nonspace)
-                        # Note, we don't adjsut offset because the tag is part of the text
+                for matcher in block_starts.get(buf[first_nonspace], ()):
+                    started = matcher(self, container, buf, end, line_number, offset, first_nonspace, indent)
+                    if started is not None:
                         break
-
-                    else:
-                        match = re.match(r'^(?:=+|-+) *$', line[first_nonspace:])
-                        if container.t == 'Paragraph' and len(container.strings) == 1 and match:
-                            # Setext header line
-                            closeUnmatchedBlocks.already_done = False
-                            closeUnmatchedBlocks(self)
-                            oldtip = closeUnmatchedBlocks.oldtip
-                            container.t = 'SetextHeader'  # Convert Paragraph to SetextHeader
-                            container.level = 1 if match.group(0)[0] == '=' else 2
-                            offset = len(line)
-
-                        elif match_at(reHrule, line, first_nonspace) is not None:
-                            # Hrule
-                            closeUnmatchedBlocks.already_done = False
-                            closeUnmatchedBlocks(self)
-                            oldtip = closeUnmatchedBlocks.oldtip
-                            container = self.add_child('HorizontalRule', line_number, first_nonspace)
-                            offset = len(line) - 1
-                            break
-
-                        else:
-                            data = parse_list_marker(line, first_nonspace)
-                            if data:
-                                # List item
-                                closeUnmatchedBlocks.already_done = False
-                                closeUnmatchedBlocks(self)
-                                oldtip = closeUnmatchedBlocks.oldtip
-                                data.marker_offset = indent
-                                offset = first_nonspace + data.padding
-
-                                # Add the list if needed
-                                if container.t != 'List' or not lists_match(container.list_data, data):
-                                    container = self.add_child('List', line_number, first_nonspace)
-                                    container.list_data = data
-
-                                # Add the list item
-                                container = self.add_child('ListItem', line_number, first_nonspace)
-                                container.list_data = data
-
-                            else:
-                                break
+                else:
+                    break
+                container, offset, done = started
+                if done:
+                    break
 
             if accepts_lines(container.t):
                 # If it's a line container, it can't contain other containers.
@@ -1328,32 +2397,41 @@ class DocParser(Dumper):
 
         # What remains at the offset is a text line.  Add the text to the
         # appropriate container.
-        match = match_at(re.compile(r'[^ ]'), line, offset)
-        if match is None:
-            first_nonspace = len(line)
-            blank = True
-        else:
-            first_nonspace = match
-            blank = False
+        if offset != scanned_offset:
+            scans += 1
+            match = reNonSpace.search(buf, offset, end)
+            if match is None:
+                first_nonspace = end
+                blank = True
+            else:
+                first_nonspace = match.start()
+                blank = False
         indent = first_nonspace - offset
 
         # First check for a lazy paragraph continuation
         if self.tip != last_matched_container and not blank and self.tip.t == 'Paragraph' and self.tip.strings:
             # Lazy paragraph continuation
             self.last_line_blank = False
-            self.add_line(line, offset)
+            self.add_line(buf, offset, end)
 
         else:
             # Not a lazy continuation
             # Finalize any blocks not matched
-            closeUnmatchedBlocks.already_done = False
-            closeUnmatchedBlocks(self)
-            oldtip = closeUnmatchedBlocks.oldtip
+            self.close_unmatched_blocks(line_number)
 
             # Block quote lines are never blank as they start with >
             # and we don't count blanks in fenced code for purposes of tight/loose
             # lists or breaking out of lists.  We also don't set last_line_blank
             # on an empty list item.
+            if open_blocks[-1] is container:
+                for cont in open_blocks:
+                    cont.last_line_blank = False
+            else:
+                cont = container
+                while cont.parent:
+                    cont.parent.last_line_blank = False
+                    cont = cont.parent
+
             container.last_line_blank = (
                 blank and
                     not (container.t in ['BlockQuote', 'FencedCode'] or
@@ -1361,38 +2439,36 @@ class DocParser(Dumper):
                             not container.children and
                             container.start_line == line_number)))
 
-            cont = container
-            while cont.parent:
-                cont.parent.last_line_blank = False
-                cont = cont.parent
-
             if container.t in ['IndentedCode', 'HtmlBlock']:
-                self.add_line(line, offset)
+                self.add_line(buf, offset, end)
 
             elif container.t == 'FencedCode':
                 # Check for closing code fence.
-                match = re.match(r'^(?:`{3,}|~{3,})(?= *$)', line[first_nonspace:])
-                if indent <= 3 and first_nonspace < len(line) and line[first_nonspace] == container.fence_char and match and len(match.group(0)) >= container.fence_length:
+                scans += 1
+                match = reClosingCodeFence.match(buf, first_nonspace, end)
+                if indent <= 3 and first_nonspace < end and buf[first_nonspace] == container.fence_char and match and len(match.group(0)) >= container.fence_length:
                     # Don't add closing fence to container instead, close it.
                     self.finalize(container, line_number)
                 else:
-                    self.add_line(line, offset)
+                    self.add_line(buf, offset, end)
 
             elif container.t in ['ATXHeader', 'SetextHeader', 'HorizontalRule']:
                 # Nothing to do we already added the contents
                 pass
             else:
                 if accepts_lines(container.t):
-                    self.add_line(line, first_nonspace)
+                    self.add_line(buf, first_nonspace, end)
                 elif blank:
                     pass
                 elif container.t not in ['HorizontalRule', 'SetextHeader']:
                     # Create Paragraph container for line.
                     container = self.add_child('Paragraph', line_number, first_nonspace)
-                    self.add_line(line, first_nonspace)
+                    self.add_line(buf, first_nonspace, end)
                 else:
                     logger.warning('Line {0} with container type {1} did not match any condition.'.format(line_number, container.t))
 
+        if self.stats is not None:
+            self.stats.count_regex('block', scans)
 
     def finalize(self, block, line_number):
         """
@@ -1403,10 +2479,24 @@ class DocParser(Dumper):
         parent of the closed block.
         
         """
-        pos = None
         # Don't do anything if the block is already closed.
         if not block.open:
             return 0
+        stats = self.stats
+        if stats is None:
+            return self.close_block(block, line_number)
+        stats.enter('finalize')
+        try:
+            self.close_block(block, line_number)
+        finally:
+            stats.leave()
+        stats.count_block(block)
+
+    def close_block(self, block, line_number):
+        """ Close an open block and do the postprocessing of finalize.
+        """
+        pos = None
+        stats = self.stats
         block.open = False
         if line_number > block.start_line:
             block.end_line = line_number - 1
@@ -1414,36 +2504,50 @@ class DocParser(Dumper):
             block.end_line = line_number
 
         if block.t == 'Paragraph':
-            block.string_content = re.sub(r'^  *', '', '\n'.join(block.strings), re.M)
+            block.string_content = reInitialSpaces.sub('', join_spans(block.strings))
 #             print 'CONTENT', block.string_content
             # Try parsing the beginning as link reference definitions.
-            pos = self.inlineParser.parse_reference(block.string_content, self.refmap)
-#             print 'AFTER', pos, block.string_content[0], repr(block.string_content[pos:])
-            while block.string_content[0] == '[' and pos:
-                block.string_content = block.string_content[pos:]
-                if is_blank(block.string_content):
-                    block.t = 'ReferenceDef'
-                    break
-                else:
-                    while block.string_content[0] == '\n':
-                        block.string_content = block.string_content[1:]
-
-                pos = self.inlineParser.parse_reference(block.string_content, self.refmap)
-#             print 'AFTER', pos, block.string_content
+            # Track the start of the remaining content as an offset so that
+            # a long run of definitions isn't re-copied after each one.
+            content = block.string_content
+            start = 0
+            if stats is not None:
+                stats.enter('references')
+            try:
+                definitions = OrderedDict()
+                pos = self.inlineParser.parse_reference(content, definitions)
+                while pos:
+                    start += pos
+                    if reBlank.match(content, start):
+                        block.t = 'ReferenceDef'
+                        break
+                    else:
+                        while content[start] == '\n':
+                            start += 1
+
+                    pos = self.inlineParser.parse_reference(content, definitions, start)
+                block.string_content = content[start:]
+                if definitions:
+                    block.reference_definitions = definitions.items()
+                    for label, link in block.reference_definitions:
+                        self.refmap.setdefault(label, link)
+            finally:
+                if stats is not None:
+                    stats.leave()
 
         elif block.t in ['ATXHeader', 'SetextHeader', 'HtmlBlock']:
-            block.string_content = '\n'.join(block.strings)
+            block.string_content = join_spans(block.strings)
 
         elif block.t == 'IndentedCode':
-            block.string_content = re.sub(r'(\n *)*$', '\n', '\n'.join(block.strings))
+            block.string_content = reTrailingBlankLines.sub('\n', join_spans(block.strings))
 
         elif block.t == 'FencedCode':
             # First line becomes info string.
-            block.info = unescape(unescape_html(block.strings[0].strip()))
+            block.info = unescape(unescape_html(join_spans(block.strings[:1]).strip()))
             if len(block.strings) == 1:
                 block.string_content = ''
             else:
-                block.string_content = '\n'.join(block.strings[1:]) + '\n'
+                block.string_content = join_spans(block.strings[1:]) + '\n'
 
         elif block.t == 'List':
             block.tight = True  # Tight by default
@@ -1466,57 +2570,299 @@ class DocParser(Dumper):
         else:
             pass
 
-        self.tip = block.parent or self.top
+        # The text is in string_content now; don't keep the buffers alive.
+        block.strings = []
+
+        open_blocks = self.open_blocks
+        if open_blocks and open_blocks[-1] is block:
+            open_blocks.pop()
+            self.tip = block.parent or self.top
+        else:
+            self.set_tip(block.parent or self.top)
 
     def process_inlines(self, block):
         """
-        Walk through a block & children recursively, parsing string content
-        into inline content where appropriate.
+        Walk through a block & children, parsing string content into
+        inline content where appropriate.
         
         """
-        if block.t in ['Paragraph', 'SetextHeader', 'ATXHeader']:
-            block.inline_content = self.inlineParser.parse(block.string_content.strip(), self.refmap)
-            block.string_content = ''
-        else:
-            pass
+        stats = self.stats
+        if stats is not None:
+            stats.enter('inline')
+        try:
+            for leaf in inline_blocks(block):
+                content = leaf.string_content.strip()
+                if self.memo is None:
+                    leaf.inline_content = self.inlineParser.parse(content, self.refmap)
+                else:
+                    leaf.inline_content = self.memo.inlines(self.inlineParser, leaf.t, content, self.refmap)
+                leaf.string_content = ''
+                if stats is not None:
+                    stats.count_inlines(leaf.inline_content)
+        finally:
+            if stats is not None:
+                stats.leave()
+
+    def incorporate_buffer(self, final=False):
+        """
+        Incorporate the complete lines in the buffer, leaving the rest for
+        a later call.  A line is only complete once at least two more
+        characters have been seen: a trailing '\r' might be the first half
+        of '\r\n', and the final newlines of the document are dropped.
+        With final set, everything left is incorporated.
+        
+        """
+        stats = self.stats
+        if stats is not None:
+            stats.enter('block')
+            first_line = self.line_number
+        try:
+            buf = u''.join([self.buffer] + self.pending) if self.pending else self.buffer
+            self.pending = []
+            end = len(buf)
+            if final:
+                # Drop the final newlines, as reFinalNewline.sub would, without
+                # copying the buffer.
+                end -= 2 if buf.endswith('\n\n') else 1 if buf.endswith('\n') else 0
+            start = 0
+            deadline = self.deadline
+            for match in reLineEnding.finditer(buf, self.scanned, end):
+                if not final and match.end() > len(buf) - 2:
+                    break
+                if deadline is not None and default_timer() > deadline:
+                    raise LimitExceeded('time_limit', self.inlineParser.time_limit)
+                self.line_number += 1
+                self.incorporate_span(buf, start, match.start(), self.line_number)
+                start = match.end()
+
+            if final:
+                self.line_number += 1
+                self.incorporate_span(buf, start, end, self.line_number)
+                self.buffer = u''
+                self.scanned = 0
+            else:
+                self.buffer = buf[start:]
+                self.scanned = max(0, len(self.buffer) - 3)
+        finally:
+            if stats is not None:
+                stats.lines += self.line_number - first_line
+                stats.leave()
+
+    def feed(self, chunk):
+        """
+        Feed a chunk of the document to the parser.  Chunks may be text or
+        UTF-8 encoded bytes and can split lines, line endings and encoded
+        characters anywhere.  Call close() to get the document; the next
+        chunk fed after that starts a new one.
+        
+        """
+        if not self.doc.open:
+            self.reset()
+        self.start_clock()
+        self.check_input_size(len(chunk))
+        if isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk)
+        # Chunks are only joined and scanned once they bring a line ending,
+        # so a long line arriving in many chunks isn't copied repeatedly.
+        self.pending.append(chunk)
+        if '\n' in chunk or '\r' in chunk:
+            self.incorporate_buffer()
+
+    def check_input_size(self, n):
+        """
+        Count n more units of input, raising LimitExceeded if that takes
+        the input over max_input_size.
+        
+        """
+        self.input_size += n
+        if self.max_input_size is not None and self.input_size > self.max_input_size:
+            raise LimitExceeded('max_input_size', self.input_size)
+
+    def close(self):
+        """
+        Finish a document fed with feed().  Returns the parsed document AST,
+        which is empty if nothing was fed since the last close().
+        
+        """
+        if not self.doc.open:
+            self.reset()
+        try:
+            self.finalize_document()
+#             print 'PREINLINE'
+#             pprint(self.doc.dump())
+            self.process_inlines(self.doc)
+        finally:
+            self.stop_clock()
+        return self.doc
+
+    def finalize_document(self):
+        """
+        Incorporate the rest of the input and finalize every open block.
+        
+        """
+        tail = self.decoder.decode(b'', True)
+        if tail:
+            self.pending.append(tail)
+        self.incorporate_buffer(final=True)
+        while self.tip:
+            self.finalize(self.tip, self.line_number - 1)
+
+    def iter_parse(self, chunks, defer_references=True):
+        """
+        Parse a document from an iterable of chunks, as accepted by feed()
+        (a file object will do), yielding each top-level block as soon as
+        it has been finalized and its inlines processed.  Yielded blocks
+        are removed from the document, so only the open blocks, the refmap
+        and any blocks held back for forward references are kept.
+
+        A block using a reference label that isn't defined yet is held back,
+        with every block after it to keep document order, until the label
+        is defined or the document ends.  With defer_references=False,
+        references must precede their use and nothing is held back.
+        
+        """
+        self.reset()
+        held = deque()
+        for chunk in chunks:
+            self.feed(chunk)
+            for block in self.pop_finished_blocks(held, defer_references):
+                yield block
+
+        self.finalize_document()
+        for block in self.pop_finished_blocks(held, defer_references, final=True):
+            yield block
+        self.stop_clock()
+
+    def pop_finished_blocks(self, held, defer_references, final=False):
+        """
+        Move the finalized top-level blocks onto held, then process and
+        yield blocks from the front of held until one has to wait for a
+        reference definition.
+        
+        """
+        children = self.doc.children
+        count = len(children)
+        if children and children[-1].open:
+            count -= 1
+        held.extend(children[:count])
+        del children[:count]
+
+        while held:
+            block = held[0]
+            if not defer_references or final:
+                self.process_inlines(block)
+            else:
+                waiting = block.missing_references
+                if waiting and not any(label in self.refmap for label in waiting):
+                    break
+
+                # Keep the string content in case it has to be parsed again.
+                contents = [(leaf, leaf.string_content) for leaf in inline_blocks(block)]
+                self.inlineParser.reference_labels = set()
+                self.process_inlines(block)
+                labels = self.inlineParser.reference_labels
+                self.inlineParser.reference_labels = None
+                missing = set(label for label in labels if label not in self.refmap)
+                if missing:
+                    for leaf, string_content in contents:
+                        leaf.string_content = string_content
+                    block.missing_references = missing
+                    break
+
+            held.popleft()
+            yield block
+
+    def parse_table(self, text):
+        """
+        Parse a document into a NodeTable.  Top-level blocks are added to
+        the table as iter_parse finishes them, so the Block and Inline
+        objects of the whole document never exist at once.
+        
+        """
+        table = NodeTable()
+        root = table.add_node('Document', -1)
+        for block in self.iter_parse([text]):
+            table.add_block(block, root)
+        table.start_lines[root] = self.doc.start_line
+        table.start_columns[root] = self.doc.start_column
+        table.end_lines[root] = self.doc.end_line
+        table.finish()
+        return table
+
+    def parse_file(self, fileobj):
+        """
+        Parse a document read in chunks from a file object, opened in
+        either text or binary mode.  Returns a parsed document AST.
+        
+        """
+        self.reset()
+        while True:
+            chunk = fileobj.read(self.chunk_size)
+            if not chunk:
+                break
+            self.feed(chunk)
+        return self.close()
 
-        if block.children:
-            for child in block.children:
-                self.process_inlines(child)
+    def parse_path(self, path):
+        """
+        Parse the UTF-8 file at path, memory-mapping it instead of reading
+        it into a string.  Returns a parsed document AST.
+        
+        """
+        self.reset()
+        for chunk in mapped_chunks(path, self.chunk_size):
+            self.feed(chunk)
+        return self.close()
 
     def parse(self, text):
         """ The main parsing function.  Returns a parsed document AST.
         """
-        self.doc = Block.makeBlock('Document', 1, 1)
-        self.tip = self.doc
-        self.refmap = dict()
-        lines = re.split(r'\r\n|\n|\r', re.sub(r'\n$', '', text))
-        for i, line in enumerate(lines):
-            self.incorporate_line(line, i + 1)
-        while self.tip:
-            self.finalize(self.tip, len(lines) - 1)
-#         print 'PREINLINE'
-#         pprint(self.doc.dump())
-        self.process_inlines(self.doc)
-        return self.doc
+        self.reset()
+        self.start_clock()
+        self.check_input_size(len(text))
+        self.buffer = text
+        return self.close()
 
 
 class HtmlRenderer(Dumper):
 
-    def __init__(self):
+    # Number of escaped URLs remembered by url_escape.
+    url_cache_size = 4096
+
+    def __init__(self, memo=None, stats=None, max_depth=None):
         super(HtmlRenderer, self).__init__()
         self.blocksep = '\n'
         self.innersep = '\n'
         self.softbreak = '\n'
+        # A BlockMemo to reuse the HTML of blocks rendered before.
+        self.memo = memo
+        # A ParseStats to record rendering time in, if any.
+        self.stats = stats
+        # Rendering recurses once or twice per level of the tree, so trees
+        # deeper than this raise LimitExceeded instead of running into the
+        # recursion limit.  None for no limit.
+        self.max_depth = max_depth
+        # Maps (URL, preserve_entities) to the result of url_escape, in
+        # the order they were added.
+        self.url_cache = OrderedDict()
 
     @staticmethod
-    def in_tags(tag, attrs, contents, selfclosing=False):
-        result = '<' + tag
+    def tag_attrs(attrs):
+        result = ''
         if attrs:
             for attr in attrs:
                 if attr is None:
                     break
                 result += u' {0}="{1}"'.format(attr[0], attr[1])
+        return result
+
+    @staticmethod
+    def start_tag(tag, attrs):
+        return '<' + tag + HtmlRenderer.tag_attrs(attrs) + '>'
+
+    @staticmethod
+    def in_tags(tag, attrs, contents, selfclosing=False):
+        result = '<' + tag + HtmlRenderer.tag_attrs(attrs)
 
         if contents:
             result += u'>{0}</{1}>'.format(contents, tag)
@@ -1527,21 +2873,39 @@ class HtmlRenderer(Dumper):
         return result
 
     def url_escape(self, s, preserve_entities=False):
-        return self.escape(url_fix(s), preserve_entities)
+        """
+        Percent-encode and escape a URL for an attribute.  Documents often
+        repeat the same URLs, so the last url_cache_size are remembered.
+        The cache isn't locked, which is one reason a renderer must not be
+        used by two threads at once.
+        
+        """
+        key = (s, preserve_entities)
+        result = self.url_cache.get(key)
+        if result is None:
+            result = self.escape(url_fix(s), preserve_entities)
+            if len(self.url_cache) >= self.url_cache_size:
+                self.url_cache.popitem(last=False)
+            self.url_cache[key] = result
+        return result
 
     def escape(self, s, preserve_entities=False):
-        if preserve_entities:
-            s = re.sub(r'[&](?![#](x[a-f0-9]{1,8}|[0-9]{1,8};)|[a-z][a-z0-9]{1,31};)', '&amp;', s, flags=re.I)
-            s = re.sub(r'[<]', '&lt;', s)
-            s = re.sub(r'[>]', '&gt;', s)
-            s = re.sub(r'["]', '&quot;', s)
-            return s
-        else:
-            s = re.sub(r'[&]', '&amp;', s)
-            s = re.sub(r'[<]', '&lt;', s)
-            s = re.sub(r'[>]', '&gt;', s)
-            s = re.sub(r'["]', '&quot;', s)
+        """
+        Escape &, <, > and " in s; with preserve_entities, an & starting
+        an entity is left alone.  Most strings have nothing to escape and
+        are returned as they are after a single scan.  The others go
+        through str.replace, which beats a regex with a callback per match
+        or unicode.translate on text full of special characters.
+        
+        """
+        if reHtmlSpecial.search(s) is None:
             return s
+        if '&' in s:
+            if preserve_entities:
+                s = reAmpNotEntity.sub('&amp;', s)
+            else:
+                s = s.replace('&', '&amp;')
+        return s.replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
 
     def render_inline(self, inline):
         """ Render an inline element as HTML.
@@ -1568,7 +2932,7 @@ class HtmlRenderer(Dumper):
             return self.in_tags('a', attrs, self.render_inlines(inline.label))
         elif inline.t == 'Image':
             attrs = [
-                ['src', self.escape(inline.destination, True)],
+                ['src', self.url_escape(inline.destination, True)],
                 ['alt', self.escape(self.render_inlines(inline.label))],
             ]
             if inline.title:
@@ -1583,35 +2947,118 @@ class HtmlRenderer(Dumper):
     def render_inlines(self, inlines):
         """ Render a list of inlines.
         """
-        result = []
+        return ''.join(self.iter_render_inlines(inlines))
+
+    def iter_render_inlines(self, inlines):
+        """ Render a list of inlines as a sequence of HTML fragments.
+        """
         for inline in inlines:
-            result.append(self.render_inline(inline))
-        return ''.join(result)
+            yield self.render_inline(inline)
+
+    def check_depth(self, block, outer=0):
+        """
+        Raise LimitExceeded if block, inside outer levels of blocks, is
+        nested deeper than max_depth.
+        
+        """
+        if self.max_depth is not None:
+            depth = outer + tree_depth(block)
+            if depth > self.max_depth:
+                raise LimitExceeded('max_depth', depth)
 
     def render_block(self, block, in_tight_list=False):
         """ Render a single block element.
+        """
+        self.check_depth(block)
+        if self.stats is None:
+            return ''.join(self.iter_render(block, in_tight_list))
+        self.stats.enter('render')
+        try:
+            return ''.join(self.iter_render(block, in_tight_list))
+        finally:
+            self.stats.leave()
+
+    def render_table(self, table):
+        """ Render a NodeTable made by DocParser.parse_table.
+        """
+        return self.render_block(table.node(0))
+
+    def render_to(self, block, write):
+        """
+        Render a block, passing the HTML to write one fragment at a time
+        (e.g. write=sys.stdout.write), without building the whole output.
+        
+        """
+        self.check_depth(block)
+        if self.stats is not None:
+            self.stats.enter('render')
+        try:
+            for chunk in self.iter_render(block):
+                write(chunk)
+        finally:
+            if self.stats is not None:
+                self.stats.leave()
+
+    def iter_render_document(self, blocks):
+        """
+        Render an iterable of top-level blocks (e.g. from
+        DocParser.iter_parse) as a document, as a sequence of HTML fragments.
+        
+        """
+        if self.max_depth is not None:
+            blocks = self.iter_checked(blocks)
+        empty = True
+        for chunk in self.iter_render_blocks(blocks):
+            empty = empty and not chunk
+            yield chunk
+        if not empty:
+            yield '\n'
+
+    def iter_checked(self, blocks):
+        """ Pass on top-level blocks, checking the depth of each.
+        """
+        for block in blocks:
+            self.check_depth(block, 1)
+            yield block
+
+    def iter_render(self, block, in_tight_list=False):
+        """
+        Render a single block element as a sequence of HTML fragments, in
+        document order.  Only the chain of blocks being rendered is held
+        in memory, so the first fragments are available before the rest
+        of the document has been rendered.
+        
         """
         tag = None
         attr = None
         info_words = None
 
         if block.t == 'Document':
-            whole_doc = self.render_blocks(block.children)
-            return '' if whole_doc == '' else whole_doc + '\n'
+            for chunk in self.iter_render_document(block.children):
+                yield chunk
 
-        elif block.t == 'Paragraph':
-            if in_tight_list:
-                return self.render_inlines(block.inline_content)
+        elif block.t in ['Paragraph', 'ATXHeader', 'SetextHeader']:
+            if self.memo is not None:
+                yield self.memo.render(self, block, in_tight_list)
             else:
-                return self.in_tags('p', [], self.render_inlines(block.inline_content))
+                for chunk in self.iter_render_leaf(block, in_tight_list):
+                    yield chunk
 
         elif block.t == 'BlockQuote':
-            filling = self.render_blocks(block.children)
-            filling = self.innersep if filling == '' else self.innersep + filling + self.innersep
-            return self.in_tags('blockquote', [], filling)
+            yield self.start_tag('blockquote', []) + self.innersep
+            empty = True
+            for chunk in self.iter_render_blocks(block.children):
+                empty = empty and not chunk
+                yield chunk
+            if not empty:
+                yield self.innersep
+            yield '</blockquote>'
 
         elif block.t == 'ListItem':
-            return self.in_tags('li', [], self.render_blocks(block.children, in_tight_list).strip())
+            yield self.start_tag('li', [])
+            for chunk in strip_chunks(self.iter_render_blocks(block.children, in_tight_list)):
+                yield chunk
+            yield '</li>'
 
         elif block.t == 'List':
             tag = 'ul' if block.list_data.type == 'Bullet' else 'ol'
@@ -1620,46 +3067,537 @@ class HtmlRenderer(Dumper):
             else:
                 attr = [['start', str(block.list_data.start)]]
 
-            return self.in_tags(tag, attr, self.innersep +
-                          self.render_blocks(block.children, block.tight) +
-                          self.innersep)
-
-        elif block.t in ['ATXHeader', 'SetextHeader']:
-            tag = 'h{}'.format(block.level)
-            return self.in_tags(tag, [], self.render_inlines(block.inline_content))
+            yield self.start_tag(tag, attr) + self.innersep
+            for chunk in self.iter_render_blocks(block.children, block.tight):
+                yield chunk
+            yield self.innersep + '</{0}>'.format(tag)
 
         elif block.t == 'IndentedCode':
-            return self.in_tags('pre', [], self.in_tags('code', [], self.escape(block.string_content)))
+            yield self.in_tags('pre', [], self.in_tags('code', [], self.escape(block.string_content)))
 
         elif block.t == 'FencedCode':
-            info_words = re.split(r' +', block.info)
+            info_words = reInfoSeparator.split(block.info)
             if not info_words or not len(info_words[0]):
                 attr = []
             else:
                 attr = [['class', 'language-' + self.escape(info_words[0], True)]]
-            return self.in_tags('pre', [], self.in_tags('code', attr, self.escape(block.string_content)))
+            yield self.in_tags('pre', [], self.in_tags('code', attr, self.escape(block.string_content)))
 
         elif block.t == 'HtmlBlock':
-            return block.string_content
+            yield block.string_content
 
         elif block.t == 'ReferenceDef':
-            return ""
+            yield ""
 
         elif block.t == 'HorizontalRule':
-            return self.in_tags('hr', [], "", True)
+            yield self.in_tags('hr', [], "", True)
 
         else:
             logger.warning('Unknown block type: {}'.format(block.t))
-            return ''
+            yield ''
+
+    def render_leaf(self, block, in_tight_list=False):
+        """ Render a paragraph or header.
+        """
+        return ''.join(self.iter_render_leaf(block, in_tight_list))
+
+    def iter_render_leaf(self, block, in_tight_list=False):
+        """
+        Render a paragraph or header, the blocks holding inlines, as a
+        sequence of HTML fragments.
+        
+        """
+        if block.t == 'Paragraph':
+            if in_tight_list:
+                for chunk in self.iter_render_inlines(block.inline_content):
+                    yield chunk
+            else:
+                yield self.start_tag('p', [])
+                for chunk in self.iter_render_inlines(block.inline_content):
+                    yield chunk
+                yield '</p>'
+        else:
+            tag = 'h{}'.format(block.level)
+            yield self.start_tag(tag, [])
+            for chunk in self.iter_render_inlines(block.inline_content):
+                yield chunk
+            yield '</{0}>'.format(tag)
 
     def render_blocks(self, blocks, in_tight_list=False):
         """ Render a list of block elements, separated by this.blocksep.
         """
-        result = []
+        return ''.join(self.iter_render_blocks(blocks, in_tight_list))
+
+    def iter_render_blocks(self, blocks, in_tight_list=False):
+        """
+        Render a list of block elements, separated by this.blocksep, as a
+        sequence of HTML fragments.
+        
+        """
+        first = True
         for block in blocks:
             if block.t != 'ReferenceDef':
-                result.append(self.render_block(block, in_tight_list))
-        return self.blocksep.join(result)
+                if not first:
+                    yield self.blocksep
+                first = False
+                for chunk in self.iter_render(block, in_tight_list):
+                    yield chunk
+
 
 
 
+class IncrementalDocument(Dumper):
+    """
+    A parsed document kept up to date through line edits, for live
+    previews.  An edit re-parses only the top-level blocks it can affect
+    and splices them into the tree; inlines and HTML are redone only for
+    those blocks and for blocks using a reference definition that changed.
+    Each edit still does work linear in the document: the lines and the
+    top-level blocks are kept in lists, an edit adding or removing lines
+    shifts the line numbers of every block after it, and a changed
+    definition rebuilds the refmap from all the top-level blocks.
+    
+    """
+
+    def __init__(self, text=u'', renderer=None):
+        super(IncrementalDocument, self).__init__()
+        self.parser = DocParser()
+        self.renderer = renderer or HtmlRenderer()
+        self.set_text(text)
+
+    def set_text(self, text):
+        """
+        Parse text from scratch, replacing the whole document.
+        
+        """
+        self.lines = reLineEnding.split(reFinalNewline.sub('', text))
+        self.doc = Block.makeBlock('Document', 1, 1)
+        self.refmap = {}
+        # Keyed by top-level block: the reference definitions made in it,
+        # the reference labels its inlines looked up and its HTML.
+        self.definitions = {}
+        self.labels = {}
+        self.html = {}
+        blocks, stop = self.parse_lines(1, None)
+        self.splice(0, 0, blocks)
+        return self.doc
+
+    def edit(self, start, stop, lines):
+        """
+        Replace self.lines[start:stop] (counting lines from 0) with the
+        list of lines and update the document.  Returns the document.
+        
+        """
+        delta = len(lines) - (stop - start)
+        self.lines[start:stop] = lines
+        children = self.doc.children
+        starts = [block.start_line for block in children]
+
+        # Everything up to the last block starting before the edit is
+        # unaffected, and since that block was opened at the top level
+        # parsing can restart there with a fresh parser.
+        first = bisect.bisect_right(starts, start) - 1
+        if first < 0:
+            first = 0
+            begin = 1
+        else:
+            begin = starts[first]
+
+        def resync(line_number):
+            # Index of the old block starting on line_number of the new
+            # text after the edit, if any.
+            old_line = line_number - delta
+            i = bisect.bisect_left(starts, old_line)
+            if old_line > stop and i < len(starts) and starts[i] == old_line:
+                return i
+            return None
+
+        blocks, last = self.parse_lines(begin, resync)
+        if last is None:
+            last = len(children)
+        if delta:
+            for old in children[last:]:
+                for block in walk_blocks(old):
+                    block.start_line += delta
+                    block.end_line += delta
+        self.splice(first, last, blocks)
+        return self.doc
+
+    def parse_lines(self, line_number, resync):
+        """
+        Parse the lines from line_number on into top-level blocks.  Stops
+        at the first line opening a top-level block where resync returns
+        the index of an old block starting on the same line: from there
+        on the old blocks are unchanged.  Returns the new blocks and that
+        index, or None if parsing reached the end.
+        
+        """
+        parser = self.parser
+        parser.reset()
+        children = parser.doc.children
+        for line_number in range(line_number, len(self.lines) + 1):
+            parser.incorporate_line(self.lines[line_number - 1], line_number)
+            if (resync and children and children[-1].start_line == line_number and
+                    (len(children) < 2 or not children[-2].open)):
+                index = resync(line_number)
+                if index is not None:
+                    children.pop()
+                    return children, index
+
+        while parser.tip:
+            parser.finalize(parser.tip, len(self.lines) - 1)
+        return children, None
+
+    def splice(self, first, last, blocks):
+        """
+        Replace the top-level blocks first to last with blocks, then
+        update the refmap and the inlines and HTML of the blocks affected.
+        
+        """
+        old_blocks = self.doc.children[first:last]
+        self.doc.children[first:last] = blocks
+
+        redefined = False
+        for block in old_blocks:
+            if self.definitions.pop(block, None):
+                redefined = True
+            self.labels.pop(block, None)
+            self.html.pop(block, None)
+        for block in blocks:
+            block.parent = self.doc
+            definitions = [definition for b in walk_blocks(block)
+                           for definition in b.reference_definitions]
+            if definitions:
+                self.definitions[block] = definitions
+                redefined = True
+
+        changed = set()
+        if redefined:
+            refmap = {}
+            for block in self.doc.children:
+                for label, link in self.definitions.get(block, ()):
+                    refmap.setdefault(label, link)
+            for label in set(refmap) | set(self.refmap):
+                old, new = self.refmap.get(label), refmap.get(label)
+                if (old is None or new is None or old.destination != new.destination or
+                        old.title != new.title):
+                    changed.add(label)
+            self.refmap = refmap
+
+        for block in blocks:
+            self.process_inlines(block)
+        if changed:
+            for block in self.doc.children:
+                if block in self.labels and not changed.isdisjoint(self.labels[block]):
+                    self.process_inlines(block)
+
+    def process_inlines(self, block):
+        """
+        Parse the inlines of a top-level block and render it, noting the
+        reference labels it looks up.  Unlike DocParser.process_inlines
+        the string content is kept, in case the refmap changes.
+        
+        """
+        inline_parser = self.parser.inlineParser
+        labels = inline_parser.reference_labels = set()
+        try:
+            for leaf in inline_blocks(block):
+                leaf.inline_content = inline_parser.parse(leaf.string_content.strip(), self.refmap)
+        finally:
+            inline_parser.reference_labels = None
+        self.labels[block] = labels
+        self.html[block] = self.renderer.render_block(block)
+
+    def render(self):
+        """
+        Return the HTML of the whole document.
+        
+        """
+        html = self.renderer.blocksep.join(
+            [self.html[block] for block in self.doc.children if block.t != 'ReferenceDef'])
+        return html + '\n' if html else ''
+
+
+class DirectoryCache(Dumper):
+    """
+    A RenderCache backend keeping each rendered document in a UTF-8 file,
+    named after its key, in a local directory.
+    
+    """
+
+    def __init__(self, directory):
+        super(DirectoryCache, self).__init__()
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.html')
+
+    def get(self, key):
+        try:
+            with io.open(self.path(key), encoding='utf-8') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, key, html):
+        # Write to a temporary file first so readers never see part of it.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            f.write(unicode(html))
+        path = self.path(key)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # On Windows rename fails if the target exists.  The entry is
+            # the same HTML whoever wrote it, so replace it.
+            try:
+                os.remove(path)
+                os.rename(temp_path, path)
+            except OSError:
+                os.remove(temp_path)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.html'):
+                os.remove(os.path.join(self.directory, name))
+
+
+class RenderCache(Dumper):
+    """
+    Render documents to HTML, reusing the HTML of documents seen before.
+    Entries are keyed on a hash of the text and of the renderer's options,
+    and kept in memory in least recently used order, up to max_entries
+    entries and max_bytes bytes of UTF-8.  A backend (an object with get
+    and put, like DirectoryCache, or a directory to make one) adds a
+    second level, consulted on a miss in memory.  Safe to share between
+    threads: documents are parsed concurrently, but rendered one at a
+    time as the renderer is shared.
+    
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 2**20, backend=None, renderer=None):
+        super(RenderCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        if isinstance(backend, basestring):
+            backend = DirectoryCache(backend)
+        self.backend = backend
+        self.renderer = renderer or HtmlRenderer()
+        # Maps each key to its HTML and its size, oldest first.
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, text):
+        """
+        Return the cache key of text, rendered by this cache's renderer.
+        
+        """
+        options = sorted((k, v) for k, v in self.renderer.attributes().items()
+                         if isinstance(v, (basestring, int, float)))
+        digest = hashlib.sha1(repr((type(self.renderer).__name__, options)))
+        digest.update(text.encode('utf-8') if isinstance(text, unicode) else text)
+        return digest.hexdigest()
+
+    def render(self, text):
+        """
+        Return the HTML of text, from the cache if possible.
+        
+        """
+        key = self.key(text)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[0]
+
+        html = self.backend.get(key) if self.backend is not None else None
+        if html is not None:
+            with self.lock:
+                self.backend_hits += 1
+        else:
+            doc = DocParser().parse(text)
+            with self.render_lock:
+                html = self.renderer.render_block(doc)
+            with self.lock:
+                self.misses += 1
+            if self.backend is not None:
+                self.backend.put(key, html)
+
+        self.store(key, html)
+        return html
+
+    def store(self, key, html):
+        size = len(html.encode('utf-8') if isinstance(html, unicode) else html)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (html, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Empty the in-memory cache.  The backend, if any, is left alone.
+        
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Return the cache counters as a dict.
+        
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'backend_hits': self.backend_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# The DocParser and HtmlRenderer of each thread calling commonmark().
+_thread_state = threading.local()
+
+
+def commonmark(text):
+    """
+    Parse a CommonMark document and return its HTML.  This is safe to
+    call from many threads at once: each thread gets its own DocParser and
+    HtmlRenderer on first use, and reuses them for its later calls, as a
+    parse starts by resetting all the parser state.  A reentrant call,
+    made while the thread's instances are in use, gets new ones.
+    
+    """
+    state = _thread_state
+    if getattr(state, 'busy', False):
+        return HtmlRenderer().render_block(DocParser().parse(text))
+    if not hasattr(state, 'parser'):
+        state.parser = DocParser()
+        state.renderer = HtmlRenderer()
+
+    state.busy = True
+    try:
+        return state.renderer.render_block(state.parser.parse(text))
+    finally:
+        # Don't keep the document alive until the thread's next call.
+        state.parser.reset()
+        state.busy = False
+
+
+def render_path(path, out, parser=None, renderer=None, defer_references=True):
+    """
+    Render the UTF-8 file at path, writing the HTML encoded as UTF-8 to
+    out, a file object opened in binary mode.  The file is memory-mapped
+    and parsed with iter_parse, so only the open blocks and the blocks
+    waiting for a reference definition are in memory at once.  A label
+    that is never defined holds back the rest of the file; with
+    defer_references=False, references must precede their use and
+    nothing is held back.
+    
+    """
+    parser = parser or DocParser()
+    renderer = renderer or HtmlRenderer()
+    blocks = parser.iter_parse(mapped_chunks(path, parser.chunk_size), defer_references)
+    for chunk in renderer.iter_render_document(blocks):
+        out.write(chunk.encode('utf-8'))
+
+
+# The parser and renderer of a parse_many or render_many worker process,
+# created once by init_worker and reused for every document.
+_worker_parser = None
+_worker_renderer = None
+
+
+def init_worker():
+    global _worker_parser, _worker_renderer
+    _worker_parser = DocParser()
+    _worker_renderer = HtmlRenderer()
+
+
+def parse_chunk(texts, parser=None, renderer=None):
+    parser = parser or _worker_parser
+    return [parser.parse(text) for text in texts]
+
+
+def render_chunk(texts, parser=None, renderer=None):
+    parser = parser or _worker_parser
+    renderer = renderer or _worker_renderer
+    return [renderer.render_block(parser.parse(text)) for text in texts]
+
+
+def map_chunks(func, iterable, workers, chunksize):
+    """
+    Yield the results of func over iterable, in order, calling func on
+    lists of up to chunksize items in a pool of worker processes.  Only
+    twice as many chunks as there are workers are in flight at a time, so
+    the iterable is consumed lazily and may be endless.
+    
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    items = iter(iterable)
+    if workers <= 1:
+        # Callers in other threads may be doing the same, so don't use the
+        # worker globals here.
+        parser = DocParser()
+        renderer = HtmlRenderer()
+        for chunk in iter(lambda: list(itertools.islice(items, chunksize)), []):
+            for result in func(chunk, parser, renderer):
+                yield result
+        return
+
+    pool = multiprocessing.Pool(workers, init_worker)
+    try:
+        pending = deque()
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(itertools.islice(items, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.apply_async(func, (chunk,)))
+            if not pending:
+                break
+            for result in pending.popleft().get():
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parse_many(texts, workers=None, chunksize=64):
+    """
+    Parse an iterable of documents in a pool of worker processes (one per
+    CPU by default), yielding the parsed documents in order.
+    
+    """
+    return map_chunks(parse_chunk, texts, workers, chunksize)
+
+
+def render_many(texts, workers=None, chunksize=64):
+    """
+    Parse and render an iterable of documents in a pool of worker
+    processes (one per CPU by default), yielding the HTML of each in order.
+    
+    """
+    return map_chunks(render_chunk, texts, workers, chunksize)
@@ -39,9 +39,7 @@ setup(
     license='MIT',
     author='Brendan Abel',
     tests_require=['pytest'],
-    install_requires=[
-        'html5charref',
-    ],
+    install_requires=[],
     cmdclass={'test': PyTest},
     author_email='007brendan@gmail.com',
     description='CommonMark-compliant Markdown parser for python.',
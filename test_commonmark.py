@@ -2,10 +2,16 @@
 from __future__ import print_function
 
 import traceback
+import io
 import re
 import os
 import sys
 import argparse
+import random
+import shutil
+import tempfile
+import threading
+import time
 from pprint import pprint, pformat
 
 import commonmark
@@ -49,16 +55,291 @@ def print_exc_plus():
 
 
 
+def stress_threads(tests, threads, rounds):
+    """
+    Render every example with commonmark.commonmark() from many threads at
+    once, each going through the examples in its own order, and check that
+    every result matches the result of a single-threaded run.
+    """
+    expected = dict((test['number'], commonmark.commonmark(test['markdown'])) for test in tests)
+    mismatches = []
+
+    def run(seed):
+        order = list(tests)
+        random.Random(seed).shuffle(order)
+        for _ in range(rounds):
+            for test in order:
+                actual = commonmark.commonmark(test['markdown'])
+                if actual != expected[test['number']]:
+                    mismatches.append(test['number'])
+
+    workers = [threading.Thread(target=run, args=(seed,)) for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    print('THREADS: {0}, CALLS: {1}'.format(threads, threads * rounds * len(tests)))
+    print('MISMATCHED: {0}'.format(len(mismatches)))
+    if mismatches:
+        print('TESTS: {0}'.format(sorted(set(mismatches))))
+
+
+def check_edits(tests, edits, seed):
+    """
+    Apply random line edits to an IncrementalDocument of each example,
+    and of runs of consecutive examples, checking the HTML after every
+    edit against a full parse of the edited text.  Inserted lines are
+    drawn from all the examples, so that edits add and remove reference
+    definitions, list items, fences and the like.
+    """
+    rng = random.Random(seed)
+    pool = [line for test in tests for line in test['markdown'].split('\n')]
+    documents = [test['markdown'] for test in tests]
+    documents += [u''.join(documents[i:i + 5]) for i in range(0, len(documents), 5)]
+    mismatches = 0
+    for text in documents:
+        doc = commonmark.IncrementalDocument(text)
+        for _ in range(edits):
+            start = rng.randint(0, len(doc.lines))
+            stop = min(len(doc.lines), start + rng.randint(0, 2))
+            lines = [rng.choice(pool) for _ in range(rng.randint(0, 2))]
+            doc.edit(start, stop, lines)
+            actual = doc.render()
+            # The parser drops up to two final newlines, so this is the
+            # text that splits into exactly doc.lines.
+            expected = commonmark.commonmark(u'\n'.join(doc.lines) + u'\n\n')
+            if actual != expected:
+                mismatches += 1
+                print('EDIT MISMATCH: lines {0}:{1} -> {2!r}'.format(start, stop, lines))
+                print(repr(u'\n'.join(doc.lines)))
+                doc.set_text(u'\n'.join(doc.lines))
+    print('DOCUMENTS: {0}, EDITS: {1}'.format(len(documents), len(documents) * edits))
+    print('MISMATCHED: {0}'.format(mismatches))
+
+
+class ItalicRenderer(commonmark.HtmlRenderer):
+    """ Renders emphasis with <i>, to tell its HTML from the default. """
+
+    def render_inline(self, inline):
+        html = super(ItalicRenderer, self).render_inline(inline)
+        if inline.t == 'Emph':
+            html = u'<i>' + html[len(u'<em>'):-len(u'</em>')] + u'</i>'
+        return html
+
+
+def check_caches(tests):
+    """
+    Check RenderCache eviction and counters, a DirectoryCache shared by
+    two RenderCaches, and a BlockMemo shared by parsers and renderers
+    configured differently, against rendering without any cache.
+    """
+    failures = []
+
+    def check(name, ok):
+        if not ok:
+            failures.append(name)
+            print('CACHE FAIL: {0}'.format(name))
+
+    texts = []
+    for test in tests:
+        if test['markdown'] not in texts:
+            texts.append(test['markdown'])
+    expected = [commonmark.commonmark(text) for text in texts]
+
+    # In-memory entries: every text misses once, the oldest are evicted
+    # beyond max_entries, and the most recent ones then hit.
+    size = 50
+    cache = commonmark.RenderCache(max_entries=size)
+    check('render', [cache.render(text) for text in texts] == expected)
+    stats = cache.stats()
+    check('misses', stats['misses'] == len(texts) and stats['hits'] == 0)
+    check('evictions', stats['evictions'] == len(texts) - size and stats['entries'] == size)
+    check('recent hits', [cache.render(text) for text in texts[-size:]] == expected[-size:])
+    check('hits', cache.stats()['hits'] == size and cache.stats()['misses'] == len(texts))
+    cache.render(texts[0])
+    check('evicted miss', cache.stats()['misses'] == len(texts) + 1)
+    cache.clear()
+    check('clear', cache.stats()['entries'] == 0 and cache.stats()['bytes'] == 0)
+
+    limit = 1000
+    cache = commonmark.RenderCache(max_bytes=limit)
+    check('max_bytes render', [cache.render(text) for text in texts] == expected)
+    check('max_bytes', 0 < cache.stats()['bytes'] <= limit)
+
+    # A second cache over the same directory finds every document there.
+    directory = tempfile.mkdtemp()
+    try:
+        first = commonmark.RenderCache(max_entries=size, backend=directory)
+        for text in texts:
+            first.render(text)
+        second = commonmark.RenderCache(max_entries=size, backend=directory)
+        check('backend render', [second.render(text) for text in texts] == expected)
+        stats = second.stats()
+        check('backend hits', stats['backend_hits'] == len(texts) and stats['misses'] == 0)
+        backend = second.backend
+        key = second.key(texts[0])
+        backend.put(key, u'replaced')
+        check('backend replace', backend.get(key) == u'replaced')
+        backend.clear()
+        check('backend clear', backend.get(key) is None and not os.listdir(directory))
+    finally:
+        shutil.rmtree(directory)
+
+    # One memo shared by parsers and renderers that give different HTML.
+    memo = commonmark.BlockMemo()
+    setups = [(limits, renderer_class)
+              for limits in [{}, {'max_inline_depth': 1}]
+              for renderer_class in [commonmark.HtmlRenderer, ItalicRenderer]]
+    plain = {}
+    for limits, renderer_class in setups:
+        reader = commonmark.DocParser(**limits)
+        writer = renderer_class()
+        plain[limits.get('max_inline_depth'), renderer_class] = [
+            writer.render_block(reader.parse(text)) for text in texts]
+    for _ in range(2):
+        for limits, renderer_class in setups:
+            reader = commonmark.DocParser(memo, **limits)
+            writer = renderer_class(memo)
+            actual = [writer.render_block(reader.parse(text)) for text in texts]
+            check('memo {0} {1}'.format(limits, renderer_class.__name__),
+                  actual == plain[limits.get('max_inline_depth'), renderer_class])
+    check('memo hits', memo.hits > 0 and memo.render_hits > 0)
+
+    # Each new definition of the label is a new variant of the paragraph.
+    memo = commonmark.BlockMemo(max_variants=4)
+    reader = commonmark.DocParser(memo)
+    for i in range(20):
+        reader.parse(u'[a]\n\n[a]: /{0}'.format(i))
+    variants = max(len(entries) for entries in memo.entries.values())
+    check('max_variants', variants == 4 and len(memo.by_inlines) <= 4 * len(memo.entries))
+
+    print('CACHE FAILURES: {0}'.format(len(failures)))
+
+
+# Inputs built to drive the parser into deep recursion or long runtimes,
+# as functions of a repeat count.
+ADVERSARIAL = [
+    ('nested-blockquotes', lambda n: u'> ' * n + u'a'),
+    ('nested-lists', lambda n: u'- ' * n + u'a'),
+    ('nested-emphasis', lambda n: u'*a ' * n + u'b' + u' a*' * n),
+    ('nested-strong', lambda n: u'***a ' * n + u'b' + u' a***' * n),
+    ('nested-links', lambda n: u'[' * n + u'a' + u'](/u)' * n),
+    ('nested-images', lambda n: u'![' * n + u'a' + u'](/u)' * n),
+    ('unmatched-brackets', lambda n: u'[a ' * n),
+    ('unmatched-emphasis', lambda n: u'*a _b ' * n),
+    ('unclosed-backticks', lambda n: u'`a ``b ' * n),
+    ('unclosed-comment', lambda n: u'a <!-- ' + u'b' * n + u'\n<x'),
+    ('unclosed-cdata', lambda n: u'a <![CDATA[ ' + u'b' * n + u'\n<x'),
+    ('long-document', lambda n: u'a *b* [c](/d)\n\n' * n),
+]
+
+
+def check_limits(limits, sizes, slack):
+    """
+    Render every adversarial input at each size with the given parser
+    limits, checking that each either renders or raises LimitExceeded
+    within the time limit plus slack seconds.
+    """
+    unbounded = 0
+    for name, make in ADVERSARIAL:
+        for n in sizes:
+            markdown = make(n)
+            reader = commonmark.DocParser(**limits)
+            writer = commonmark.HtmlRenderer()
+            start = time.time()
+            try:
+                writer.render_block(reader.parse(markdown))
+                result = 'ok'
+            except commonmark.LimitExceeded as e:
+                result = e.limit
+            except Exception as e:
+                result = type(e).__name__
+            elapsed = time.time() - start
+            bounded = result in ['ok', 'max_input_size', 'max_depth', 'time_limit'] and \
+                elapsed <= limits['time_limit'] + slack
+            if not bounded:
+                unbounded += 1
+            print('LIMITS: {0} x {1} ({2} chars): {3} in {4:.3f}s{5}'.format(
+                name, n, len(markdown), result, elapsed, '' if bounded else ' UNBOUNDED'))
+    print('UNBOUNDED: {0}'.format(unbounded))
+
+
+def check_delayed_feed(time_limit):
+    """
+    Stream two documents through one parser with time_limit, waiting
+    longer than the limit before each: the clock must only start with
+    each document's first chunk.
+    """
+    reader = commonmark.DocParser(time_limit=time_limit)
+    failures = 0
+    for n in range(2):
+        time.sleep(time_limit * 1.5)
+        try:
+            reader.feed(b'*a*\n\n')
+            reader.feed(b'b\n')
+            reader.close()
+            result = 'ok'
+        except commonmark.LimitExceeded as e:
+            failures += 1
+            result = e.limit
+        print('DELAYED FEED: document {0}: {1}'.format(n + 1, result))
+    print('DELAYED FEED FAILURES: {0}'.format(failures))
+
+
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--stop', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('-t', '--test', type=int, default=None)
+    parser.add_argument('-c', '--chunk-size', type=int, default=None,
+                        help='Feed each example to the parser as UTF-8 '
+                             'chunks of this many bytes.')
+    parser.add_argument('-i', '--iter-parse', action='store_true',
+                        help='Parse and render each example one top-level '
+                             'block at a time.')
+    parser.add_argument('-p', '--path', action='store_true',
+                        help='Write each example to a file and render it '
+                             'with commonmark.render_path, mapping -c bytes '
+                             'at a time if given.')
+    parser.add_argument('-n', '--node-table', dest='table', action='store_true',
+                        help='Parse each example into a NodeTable and render '
+                             'from the table.')
+    parser.add_argument('-m', '--memo', action='store_true',
+                        help='Share one BlockMemo between all the examples, '
+                             'warmed up by rendering them all once first.')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Render the examples with commonmark.commonmark() '
+                             'from this many threads at once, checking each '
+                             'result against a single-threaded run.')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Times each thread renders every example with '
+                             '--threads.')
+    parser.add_argument('--edits', type=int, default=None,
+                        help='Apply this many random line edits to an '
+                             'IncrementalDocument of each example, checking '
+                             'each result against a full parse.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for --edits.')
+    parser.add_argument('--caches', action='store_true',
+                        help='Check RenderCache, DirectoryCache and '
+                             'BlockMemo against rendering without them.')
+    parser.add_argument('--limits', action='store_true',
+                        help='Check that adversarial inputs are parsed in '
+                             'bounded time under parser limits, then run '
+                             'the examples with the same limits.')
     args = parser.parse_args()
 
-    writer = commonmark.HtmlRenderer()
-    reader = commonmark.DocParser()
+    limits = {}
+    if args.limits:
+        limits = dict(max_input_size=1 << 20, max_depth=100, max_inline_depth=100, time_limit=1.0)
+        check_limits(limits, [10, 1000, 100000], 1.0)
+        check_delayed_feed(0.5)
+
+    memo = commonmark.BlockMemo() if args.memo else None
+    writer = commonmark.HtmlRenderer(memo)
+    reader = commonmark.DocParser(memo, **limits)
 
 
     print('Reading spec...')
@@ -94,6 +375,25 @@ def main():
             tests.append(test)
 
 
+    if args.threads:
+        print('Running Tests in {0} threads...'.format(args.threads))
+        stress_threads(tests, args.threads, args.rounds)
+        return None
+
+    if args.caches:
+        print('Checking Caches...')
+        check_caches(tests)
+        return None
+
+    if args.edits:
+        print('Editing Tests...')
+        check_edits(tests, args.edits, args.seed)
+        return None
+
+    if memo is not None:
+        for test in tests:
+            writer.render_block(reader.parse(test['markdown']))
+
     passed = 0
     failed = 0
     print('Running Tests...')
@@ -112,8 +412,34 @@ def main():
         markdown = test['markdown']
         html = test['html']
         try:
-            actual = writer.render_block(reader.parse(markdown))
+            if args.table:
+                actual = writer.render_table(reader.parse_table(markdown))
+            elif args.path:
+                fd, path = tempfile.mkstemp()
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(markdown.encode('utf8'))
+                    if args.chunk_size:
+                        reader.chunk_size = args.chunk_size
+                    out = io.BytesIO()
+                    commonmark.render_path(path, out, reader, writer)
+                    actual = out.getvalue().decode('utf8')
+                finally:
+                    os.remove(path)
+            elif args.iter_parse:
+                chunks = markdown.encode('utf8').splitlines(True)
+                actual = ''.join(writer.iter_render_document(reader.iter_parse(chunks)))
+            elif args.chunk_size:
+                # No reset(): feeding after the last example's close()
+                # must start a new document.
+                data = markdown.encode('utf8')
+                for i in range(0, len(data), args.chunk_size):
+                    reader.feed(data[i:i + args.chunk_size])
+                actual = writer.render_block(reader.close())
+            else:
+                actual = writer.render_block(reader.parse(markdown))
         except Exception:
+            reader.reset()
             actual = None
             tmsg = print_exc_plus()
             tmsg = tmsg.encode('ascii', errors='replace')
@@ -137,9 +463,9 @@ def main():
                 if tmsg:
                     print(tmsg)
 
-                with open(r'C:\temp\commonmark_actual.txt', 'w') as f:
-                    f.write(actual.encode('utf8'))
-                with open(r'C:\temp\commonmark_html.txt', 'w') as f:
+                with open(os.path.join(tempfile.gettempdir(), 'commonmark_actual.txt'), 'w') as f:
+                    f.write((actual or u'').encode('utf8'))
+                with open(os.path.join(tempfile.gettempdir(), 'commonmark_html.txt'), 'w') as f:
                     f.write(html.encode('utf8'))
 
             if args.stop:
@@ -149,6 +475,9 @@ def main():
 
     print('PASSED: {}'.format(passed))
     print('FAILED: {}'.format(failed))
+    if memo is not None:
+        print('MEMO: {0} hits, {1} misses, {2} render hits, {3} render misses'.format(
+            memo.hits, memo.misses, memo.render_hits, memo.render_misses))
 
 
 